@@ -0,0 +1,265 @@
+import asyncio
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from utils.client_utils import PicDBBase
+
+from utils.cache_utils import check_cache_info, get_cache_images
+from utils.cache_utils import get_usable_cache_images, store_images_list
+
+from utils.upload_utils import read_image_record, make_tag_credits, make_image_document
+from utils.upload_utils import make_upload_logs
+
+from utils.feedback_utils import make_feedback_logs, make_log_requests
+
+from utils.query_cache_utils import make_rank_order
+
+from utils.db_utils import make_ranked_pipeline
+
+from utils.async_utils import get_images_id_from_database, find_image_by_digest
+from utils.async_utils import ensure_indexes, apply_tag_deltas, increment_statistics
+from utils.async_utils import find_near_duplicate_images
+from utils.async_utils import AsyncChunkedStorage, download_images
+
+
+class AsyncPicDB(PicDBBase):
+    """
+    The coroutine version of PicDB, for services running on an event loop.
+
+    It shares the image pool, the manifest and the cache catalog with PicDB,
+    and runs on motor, or on any client given to init() with the same API.
+    The local catalog and the image pool are accessed on the default
+    executor, so the event loop is never blocked by SQLite or the disk.
+    """
+
+    async def init(self, uri='mongodb://localhost:27017/', client=None, storage=AsyncChunkedStorage):
+        """
+        Initialize database connection and member variable setup
+
+        Parameters:
+        ----------
+        uri: String
+            the mongodb connection uri
+
+        client:
+            an asynchronous client to use instead of connecting to uri, for
+            example an in-process stand-in for tests
+
+        storage: Callable
+            creates the asynchronous storage backend of image content given the database
+        """
+        # The image pool and the local catalog are opened on the default executor
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.init_store)
+
+        self.uri = uri
+
+        if client is None:
+            # motor is only needed by the asynchronous client
+            from motor.motor_asyncio import AsyncIOMotorClient
+            client = AsyncIOMotorClient(self.uri)
+        self.connection = client
+
+        self.db = self.connection[self.db_name]
+        self.collection = self.db[self.db_collection]
+        self.log_collection = self.db[self.db_log_collection]
+        self.storage = storage(self.db)
+
+        await ensure_indexes(self.db)
+
+    async def ensure_indexes(self):
+        """Create the indexes declared in utils.index_utils.INDEX_SPECS"""
+        created = await ensure_indexes(self.db)
+        print(f'{len(created)} indexes are ready!')
+
+    async def upload_one_new_image(self, img_path, up_loader, tags_list_like=[], description="null", normalize=False):
+        """Upload an image with some tags and informations, see PicDB.upload_one_new_image"""
+        loop = asyncio.get_running_loop()
+
+        # The file is read and decoded on the default executor
+        record = await loop.run_in_executor(None, read_image_record, img_path, normalize)
+        if record is None:
+            print("Cannot read image ", img_path.split("/")[-1], "!")
+            return
+
+        if await find_image_by_digest(self.db, record["digest"]) is not None:
+            print("Already exist!")
+            return
+
+        if self.near_duplicate_radius is not None and record["phash"] is not None:
+            near_duplicates = await find_near_duplicate_images(
+                self.db, record["phash"], self.near_duplicate_radius)
+            if near_duplicates:
+                print(f"Near duplicate of {near_duplicates[0][0]}!")
+                return
+
+        credits_for_tags = make_tag_credits(tags_list_like)
+
+        image = make_image_document(record, up_loader, credits_for_tags, description)
+        image = await self.storage.put(image, record["content"])
+
+        try:
+            result = await self.collection.insert_one(image)
+        except DuplicateKeyError:
+            # the same content was uploaded concurrently
+            await self.storage.delete(image)
+            print("Already exist!")
+            return
+        print("upload ", img_path.split("/")[-1], " is done!")
+        # Untagged images are written under the 'image' tag
+        await loop.run_in_executor(None, self.query_cache.invalidate_tags, credits_for_tags)
+
+        logs = make_upload_logs(result.inserted_id, credits_for_tags, up_loader)
+        await self.log_collection.insert_many(logs)
+        if self.materialize_statistics:
+            await increment_statistics(self.db, logs)
+
+        return result.inserted_id
+
+    async def show_information(self, image_id):
+        result = await self.collection.find_one({"_id": ObjectId(image_id)}, {"content": 0})
+        if result is None:
+            print("Image ID is not exist !")
+        else:
+            print(result)
+            print()
+
+        return result
+
+    async def feedback(self, user, tags, ids, positive_feedback):
+        """Increase (decrease) the credits of given tags for given image ids"""
+        value = 1 if positive_feedback else -1
+        ids = [ObjectId(id) for id in ids]
+
+        tag_deltas = {tag: {id: value for id in ids} for tag in tags}
+        await apply_tag_deltas(self.db, tag_deltas, self.threshold, await self.get_tag_collections())
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.query_cache.invalidate_tags, tags)
+
+        if not positive_feedback:
+            return
+
+        logs = make_feedback_logs({(tag, user): ids for tag in tags})
+        if logs:
+            result = await self.log_collection.bulk_write(make_log_requests(logs), ordered=False)
+
+            if self.materialize_statistics:
+                await increment_statistics(self.db, [logs[i] for i in result.upserted_ids])
+
+    async def get_tag_collections(self):
+        """Get the cached set of existing tag index collections"""
+        if self.tag_collections is None:
+            self.tag_collections = set(await self.db.list_collection_names())
+
+        return self.tag_collections
+
+    async def get_images(self, tags, img_type="JPEG", use_count=-1,
+                         limit=10, use_cache=True, cache_version=0,
+                         next_cache_name="latest", batch_size=100, workers=1,
+                         ranked=False, weights=None):
+        """
+        Get Image from database, see PicDB.get_images
+
+        Parameters:
+        ----------
+        workers: Int
+            the number of shards of batch_size images downloaded concurrently
+
+        Returns:
+        ----------
+        images_list: List[String]
+            the ids of the images
+
+        """
+        # Force user to give a label for the next cache version
+        if not use_cache and next_cache_name == "latest":
+            print("You have to specify a label name for new cache version!")
+            return
+
+        loop = asyncio.get_running_loop()
+
+        # The local catalog is read and written on the default executor
+        images_list = await loop.run_in_executor(
+            None, get_usable_cache_images, self.dir_path, tags, cache_version, use_cache, limit)
+
+        if images_list is None:
+            images_list = await self.query_images_id(tags, img_type, use_count, limit, ranked, weights,
+                                                     refresh=not use_cache)
+
+        # Filter out downloaded images to only download not downloaded ones
+        to_download_list = [image_id for image_id in images_list
+                            if image_id not in self.manifest]
+
+        count, size, seconds = await download_images(
+            self.db, self.dir_path, to_download_list, self.storage, workers, batch_size,
+            self.manifest)
+
+        if count:
+            rate = size / 2**20 / seconds if seconds else float('inf')
+            print(f'Downloaded {count} images ({size / 2**20:.2f} MB) in {seconds:.2f}s, {rate:.2f} MB/s\n')
+
+        # Images requested again are used as well
+        await loop.run_in_executor(None, self.manifest.touch, [
+            image_id for image_id in images_list if image_id not in to_download_list])
+
+        await loop.run_in_executor(
+            None, store_images_list, self.dir_path, tags, images_list, img_type, use_count, limit,
+            None if use_cache else next_cache_name)
+
+        # Keep the image pool within its disk budget, files are removed on the default executor
+        if self.pool_budget is not None:
+            await loop.run_in_executor(
+                None, self.manifest.evict, self.pool_budget, self.eviction_policy)
+
+        return images_list
+
+    async def query_images_id(self, tags, img_type="JPEG", use_count=-1, limit=10, ranked=False, weights=None,
+                              refresh=False):
+        """Get the image ids of a query from the query result cache, or from the database"""
+        loop = asyncio.get_running_loop()
+        order = make_rank_order(tags, weights) if ranked else None
+
+        # A refresh queries the database and replaces the cached result, a
+        # shared cache is read and written on the default executor
+        if self.query_cache_ttl > 0 and not refresh:
+            images_list = await loop.run_in_executor(
+                None, self.query_cache.get, tags, img_type, use_count, limit, self.threshold, order)
+            if images_list is not None:
+                return images_list
+
+        if ranked:
+            images_list = [image_id for image_id, _ in await self.rank_images(
+                tags, img_type, use_count, limit, weights)]
+        else:
+            images_list = await get_images_id_from_database(
+                self.db, tags, img_type, use_count, limit, self.threshold)
+
+        if self.query_cache_ttl > 0:
+            await loop.run_in_executor(
+                None, self.query_cache.put, tags, img_type, use_count, limit, self.threshold,
+                images_list, order)
+
+        return images_list
+
+    async def rank_images(self, tags, img_type="JPEG", use_count=-1, limit=10, weights=None):
+        """Get the top images having all tags ranked by their tag credits, see PicDB.rank_images"""
+        pipeline = make_ranked_pipeline(tags, img_type, use_count, limit, weights)
+
+        return [(str(image['_id']), image['score'])
+                async for image in self.db.images.aggregate(pipeline)]
+
+    async def use_images(self, tags, cache_version=0):
+        """Get images list for given tags and cache version, the local catalog is read on the default executor"""
+        loop = asyncio.get_running_loop()
+        version, name, cache_exists = await loop.run_in_executor(
+            None, check_cache_info, self.dir_path, tags, cache_version)
+
+        if not cache_exists:
+            print(f'Version: {version} -- Name: {name} not found!\n')
+            return
+
+        cached_list = await loop.run_in_executor(None, get_cache_images, self.dir_path, tags, version)
+        await loop.run_in_executor(None, self.manifest.touch, cached_list)
+
+        return cached_list
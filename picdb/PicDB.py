@@ -1,44 +1,73 @@
 import os
-import io
-from io import BytesIO
-from os import walk
+from os import walk, listdir
+from os.path import isfile, isdir, join
 
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
-from PIL import Image
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
 
 
-from utils.dir_utils import get_home_path, get_store_path, get_dir_path
+from utils.client_utils import PicDBBase
 
-from utils.cache_utils import create_cache_dir
 from utils.cache_utils import make_cache_info, get_cache_info, check_cache_info
-from utils.cache_utils import get_next_cache_version
-from utils.cache_utils import store_downloaded_cache, read_downloaded_cache
+from utils.cache_utils import get_next_cache_version, store_cache_version
+from utils.cache_utils import list_all_cache_version, diff_cache_versions, get_tags_key
+from utils.cache_utils import get_usable_cache_images, store_images_list
 
-from utils.db_utils import get_images_id_from_database, get_images_content_from_database
+from utils.db_utils import get_images_id_from_database, get_ranked_images_from_database
+from utils.db_utils import find_image_by_digest, backfill_images_digest
 
-from utils.image_utils import save_image, get_downloaded_images_list, get_image_path
+from utils.index_utils import ensure_indexes, check_query_plans
 
+from utils.tag_index_utils import get_all_tags, rebuild_tag_index, has_tag_collection
 
-class PicDB:
-    def __init__(self):
-        self.db_name = 'picdb'
-        self.db_collection = 'images'
-        self.db_log_collection = 'logs'
-        self.threshold = 100
-    def init(self, uri='mongodb://localhost:27017/'):
-        """Initialize database connection and member variable setup"""
-        self.home_path = get_home_path()
-        self.store_path = get_store_path(self.home_path)
-        self.dir_path = get_dir_path(self.store_path)
-        if not os.path.isdir(self.store_path):
-            os.mkdir(self.store_path)
+from utils.feedback_utils import FeedbackBuffer
 
-        if not os.path.isdir(self.dir_path):
-            os.mkdir(self.dir_path)
+from utils.stats_utils import get_summary_statistics, get_materialized_statistics
+from utils.stats_utils import increment_statistics, rebuild_statistics
+
+from utils.visualize_utils import show_image_content, show_summary_statistics
+
+from utils.image_utils import save_image
+
+from utils.move_utils import move_images_to
+
+from utils.rendition_utils import ensure_renditions, get_rendition_dir
+
+from utils.shard_utils import pack_images, get_packed_dir, ShardReader
+
+from utils.upload_utils import read_image_record, make_tag_credits, make_image_document
+from utils.upload_utils import make_upload_logs, bulk_upload_images
+
+from utils.storage_utils import ChunkedStorage
+
+from utils.download_utils import download_images
+
+from utils.manifest_utils import ImageManifest
+
+from utils.query_cache_utils import make_rank_order
+
+from utils.pagination_utils import TagQueryIterator
+
+from utils.phash_utils import find_near_duplicate_images, find_near_duplicates
+from utils.phash_utils import backfill_images_phash, parse_phash
+
+
+class PicDB(PicDBBase):
+    def init(self, uri='mongodb://localhost:27017/', storage=ChunkedStorage):
+        """
+        Initialize database connection and member variable setup
+
+        Parameters:
+        ----------
+        uri: String
+            the mongodb connection uri
+
+        storage: Callable
+            creates the storage backend of image content given the database,
+            for example InlineStorage or ChunkedStorage from utils.storage_utils
+        """
+        self.init_store()
 
         self.uri = uri
 
@@ -52,71 +81,199 @@ class PicDB:
         self.db = self.connection[self.db_name]
         self.collection = self.db[self.db_collection]
         self.log_collection = self.db[self.db_log_collection]
+        self.storage = storage(self.db)
 
-    def upload_one_new_image(self, img_path, up_loader, tags_list_like=[], description="null"):
+        ensure_indexes(self.db)
 
-        # get one image
-        im = Image.open(img_path)
+    def ensure_indexes(self):
+        """Create the indexes declared in utils.index_utils.INDEX_SPECS"""
+        created = ensure_indexes(self.db)
+        print(f'{len(created)} indexes are ready!')
 
-        # convert the image to binary
-        image_bytes = io.BytesIO()
-        im.save(image_bytes, format=im.format)
+    def check_indexes(self, tags, img_type="JPEG", use_count=-1):
+        """Explain the hot queries for the given tags and warn about collection scans"""
+        collscans = check_query_plans(self.db, tags, img_type, use_count, self.threshold)
+        if not collscans:
+            print("All hot queries use an index!")
 
-        if self.collection.find_one({"content": image_bytes.getvalue()}) != None:
+        return collscans
+
+    def upload_one_new_image(self, img_path, up_loader, tags_list_like=[], description="null", normalize=False):
+        """
+        Upload an image with some tags and informations
+
+        The original file bytes are stored unless normalize is True, which
+        decodes and re-encodes the image with PIL first.
+        """
+
+        # get one image and convert it to binary
+        record = read_image_record(img_path, normalize)
+        if record is None:
+            print("Cannot read image ", img_path.split("/")[-1], "!")
+            return
+
+        # look up duplicates by content digest instead of the whole binary
+        if find_image_by_digest(self.db, record["digest"]) is not None:
             print("Already exist!")
             return
 
+        # look up resized or recompressed copies by perceptual hash
+        if self.near_duplicate_radius is not None and record["phash"] is not None:
+            near_duplicates = find_near_duplicate_images(
+                self.db, record["phash"], self.near_duplicate_radius)
+            if near_duplicates:
+                print(f"Near duplicate of {near_duplicates[0][0]}!")
+                return
+
         # create initial credits for tags
-        credits_for_tags = {}
-        logs_for_new_image = []
-        if len(tags_list_like) != 0:
-            for i in tags_list_like:
-                if i not in credits_for_tags.keys():
-                    credits_for_tags[i] = 1
-        else:
-            credits_for_tags["image"] = 1
+        credits_for_tags = make_tag_credits(tags_list_like)
 
         # create one record (row) for table
-        image = {
-            "content": image_bytes.getvalue(),
-            "description": description,
-            "img_type": str(im.format),
-            "use_count": 0,
-            "uploader": up_loader,
-            "tags": credits_for_tags
-        }
+        image = make_image_document(record, up_loader, credits_for_tags, description)
+        image = self.storage.put(image, record["content"])
 
         # insert the data into the collection
-        image_id = self.collection.insert_one(image).inserted_id
+        try:
+            image_id = self.collection.insert_one(image).inserted_id
+        except DuplicateKeyError:
+            # the same content was uploaded concurrently
+            self.storage.delete(image)
+            print("Already exist!")
+            return
         print("upload ", img_path.split("/")[-1], " is done!")
+        # Untagged images are written under the 'image' tag
+        self.query_cache.invalidate_tags(credits_for_tags)
 
         #update logs
-        for tag in credits_for_tags:
-            self.log_collection.insert_one({'tag':tag, 'user':up_loader, '_id':image_id})
+        logs = make_upload_logs(image_id, credits_for_tags, up_loader)
+        self.log_collection.insert_many(logs)
+        if self.materialize_statistics:
+            increment_statistics(self.db, logs)
+
+    def backfill_digest(self, batch_size=500):
+        """Compute content digests for images uploaded before digests were stored"""
+        updated, duplicated = backfill_images_digest(self.db, batch_size)
+        print(f'Backfilled digest for {updated} images!')
+        if duplicated:
+            print(f'{duplicated} images duplicate the content of other images!')
+
+    def backfill_phash(self, batch_size=500, workers=None):
+        """Compute the perceptual hash for images uploaded before perceptual hashes were stored"""
+        updated = backfill_images_phash(self.db, self.storage, batch_size, workers)
+        print(f'Backfilled perceptual hash for {updated} images!')
+
+    def find_similar_images(self, image_id, radius=4):
+        """
+        Find images whose perceptual hash is within radius of the given image
+
+        Returns:
+        ----------
+        similar_list: List[(String, Int)]
+            the image ids and their Hamming distances, nearest first
+        """
+        image = self.collection.find_one({'_id': ObjectId(image_id)}, {'phash': 1})
+        if image is None or 'phash' not in image:
+            print("Image ID is not exist or has no perceptual hash!")
+            return []
+
+        near_duplicates = find_near_duplicate_images(self.db, parse_phash(image['phash']), radius)
+
+        return [(str(id), distance) for id, distance in near_duplicates if id != image['_id']]
+
+    def find_near_duplicates(self, radius=4, workers=None, chunk_size=1000):
+        """
+        Cluster the images of the database whose perceptual hashes are within radius
+
+        Hashes are compared with a BK-tree queried in a process pool, and
+        images connected by a near duplicate pair form one cluster.
+
+        Returns:
+        ----------
+        clusters: List[List[String]]
+            the image ids of each cluster, oldest first
+        """
+        clusters = find_near_duplicates(self.db, radius, workers, chunk_size)
+        duplicated = sum(len(cluster) - 1 for cluster in clusters)
+        print(f'Found {len(clusters)} clusters of near duplicates, {duplicated} images could be removed!')
+
+        return clusters
+
+    def upload_file_of_new_images(self, img_file_path, up_loader, tags_list_like=[], img_type=[], description="null",
+                                  bulk=False, chunk_size=500, workers=None, normalize=False):
+        """
+        Upload all images in the given file
+
+        Parameters:
+        ----------
+        bulk: Bool
+            True: Decode images in a process pool and insert them in chunks
+            False: Upload images one by one
+
+        chunk_size: Int
+            the number of images deduplicated and inserted together in bulk mode
 
-    def upload_file_of_new_images(self, img_file_path, up_loader, tags_list_like=[], img_type=[], description="null"):
+        workers: Int
+            the number of decoding processes in bulk mode, default to the number of CPUs
+
+        normalize: Bool
+            True: Decode and re-encode images with PIL before storing them
+            False: Store the original file bytes
+
+        """
         allImagesList = os.listdir(img_file_path)
         if img_file_path[-1] != "/":
             img_file_path = img_file_path + "/"
 
+        img_paths = []
         for img in allImagesList:
             s = img.split('.')
             if s[-1] in img_type:
-                self.upload_one_new_image(img_file_path + img, up_loader, tags_list_like, description)
+                img_paths.append(img_file_path + img)
+
+        if not bulk:
+            for img_path in img_paths:
+                self.upload_one_new_image(img_path, up_loader, tags_list_like, description, normalize)
+            return
+
+        stats = bulk_upload_images(
+            self.db, self.storage, img_paths, up_loader, tags_list_like, description, chunk_size, workers, normalize,
+            self.materialize_statistics, self.near_duplicate_radius)
+        if stats["inserted"]:
+            self.query_cache.invalidate_tags(make_tag_credits(tags_list_like))
+
+        # Report throughput of each stage
+        mb = stats["bytes"] / 2**20
+        print(f'\nUploaded {stats["inserted"]} new images, '
+              f'{stats["read"] - stats["inserted"]} already exist, {stats["failed"]} failed to read!')
+        for stage, count in [("decode", stats["read"]), ("dedup", stats["read"]), ("insert", stats["inserted"])]:
+            seconds = stats[f'{stage}_time']
+            rate = count / seconds if seconds else float('inf')
+            print(f'{stage:>6}: {seconds:.2f}s, {rate:.1f} images/s')
+        total = stats["decode_time"] + stats["dedup_time"] + stats["insert_time"]
+        if total:
+            print(f' total: {total:.2f}s, {mb / total:.2f} MB/s')
+        print()
 
 
-    def show_image(self, image_id):
-        documents = self.collection.find({'_id': ObjectId(image_id)})
+    def show_image(self, image_id, size=None):
+        """
+        Display an image, or its rendition of the given max edge size
+
+        A missing rendition is generated and uploaded first, the original
+        is displayed without writing anything when size is None.
+        """
+        if size is not None:
+            ensure_renditions(self.db, self.storage, [image_id], size)
+            documents = self.db.renditions.find({'image_id': ObjectId(image_id), 'max_edge': size})
+        else:
+            documents = self.collection.find({'_id': ObjectId(image_id)})
         result = list(documents)
         if len(result) == 0:
             print("Image ID is not exist !")
             print()
         else:
-            image_data = result[0]['content']
-            image = Image.open(BytesIO(image_data))
-            plt.imshow(image)
-            plt.axis('off')
-            plt.show()
+            image_data = self.storage.read(result[0])
+            show_image_content(image_data)
             print()
 
     def show_information(self, image_id):
@@ -128,39 +285,38 @@ class PicDB:
             print(result[0])
             print()
 
-    def show_summary(self):
-        # TODO: tag_visualize, user 
-        total_image = self.collection.count_documents({})
-        top_num = 3
-        fig = plt.figure(figsize=(8, 4))
-        fig.suptitle('There are {} images in database'.format(total_image))
-        ax1 = fig.add_subplot(121)
-        ax2 = fig.add_subplot(122)
-        all_tag = self.log_collection.distinct('tag')
-        all_user = self.log_collection.distinct('user')
-        # calculate the number of each tag
-        tag_count = []
-        for tag in all_tag:
-            tag_num = self.log_collection.count_documents({'tag': tag})
-            tag_count.append([tag, tag_num])
-        tag_count = sorted(tag_count, key=lambda x: x[1], reverse=True)
-        tag_count = pd.DataFrame(tag_count[:top_num], columns=['Tag_name', 'Tag_count'])
-        sns.barplot(x='Tag_name', y='Tag_count', data=tag_count, ax=ax1)
-        ax1.set_title('Top {} tags in database'.format(top_num), fontsize=8)
-
-        # calculate the number of the user who add the tag
-        user_count = []
-        for user in all_user:
-            user_num = self.log_collection.count_documents({'user': user})
-            user_count.append([user, user_num])
-        user_count = sorted(user_count, key=lambda x: x[1], reverse=True)
-        user_count = pd.DataFrame(user_count[:top_num], columns=['User_name', 'Number'])
-        sns.barplot(x='User_name', y='Number', data=user_count, ax=ax2)
-        ax2.set_title('Top {} users to insert tag'.format(top_num), fontsize=8)
-        plt.show()
+    def show_summary(self, top_num=3, materialized=None):
+        """
+        Display the overall informations of the database
+
+        Parameters:
+        ----------
+        top_num: Int
+            the number of top tags and users to display
+
+        materialized: Bool
+            True: Read the counts kept in the stats collection
+            False: Compute the counts from the logs with one aggregation
+            default to materialize_statistics
+        """
+        if materialized is None:
+            materialized = self.materialize_statistics
+
+        if materialized:
+            summary = get_materialized_statistics(self.db, top_num)
+        else:
+            summary = get_summary_statistics(self.db, top_num)
+
+        show_summary_statistics(summary, top_num)
         print()
-        
-    def feedback_folder(self, user, tags, filepath, positive_feedback):
+
+    def rebuild_statistics(self):
+        """Recompute the materialized stats collection from the logs"""
+        rebuild_statistics(self.db)
+        print("Statistics are rebuilt!")
+
+    def feedback_folder(self, user, tags, filepath, positive_feedback, buffer=None):
+        """Give feedback to all images in a folder, which are named after their ids"""
         raw_files = [f for f in listdir(filepath) if isfile(join(filepath, f))]
         
         files = []
@@ -168,58 +324,68 @@ class PicDB:
             item = file.split('.')[0]
             if item != '': files += [item]
 
-        self.feedback(user, [tags], files, positive_feedback)
+        if buffer is None:
+            self.feedback(user, [tags], files, positive_feedback)
+        else:
+            buffer.add_many(user, [tags], files, positive_feedback)
 
     def feedback_all_folder(self, user, filepath, positive_feedback):
+        """Give feedback to images in every sub folder, tagged with the folder name"""
         raw_path = [f for f in listdir(filepath) if isdir(join(filepath, f))]
-        for path in raw_path:
-            self.feedback_folder(user, path, join(filepath, path), positive_feedback)
+        with self.feedback_buffer() as buffer:
+            for path in raw_path:
+                self.feedback_folder(user, path, join(filepath, path), positive_feedback, buffer)
 
     def feedback(self, user, tags, ids, positive_feedback):
-        
-        for tag in tags:
-            if not (tag in self.db.list_collection_names()):
-                self.db.create_collection(tag)
-
-            buf = self.db[tag]
-            entity = 'tags.%s' % tag
-            value = 1 if positive_feedback else -1
-            ids = [ObjectId(id) for id in ids]
+        """Increase (decrease) the credits of given tags for given image ids"""
+        with self.feedback_buffer() as buffer:
+            buffer.add_many(user, tags, ids, positive_feedback)
 
-            self.collection.update_many({'_id' : {'$in': ids}}, {'$inc':{ entity : value}}, upsert=True)
+    def feedback_buffer(self, interval=1.0, max_events=10000):
+        """
+        Get a buffer that coalesces feedback events and writes them in bulk
 
-            if positive_feedback:
-                result = self.collection.find({'_id' : {'$in' : ids}, entity : {'$gt' : self.threshold-1}})
-                self.log_collection.update_many({'_id' : {'$in' : ids}}, {'$set':{'tag':tag, 'user': user}}, upsert=True)
+        Use it as a context manager so the remaining events are flushed on exit:
 
-                delete_data, insert_data = [], []
+            with pic_db.feedback_buffer() as buffer:
+                buffer.add(user, tag, image_id, positive_feedback)
 
-                for item in result:
-                    delete_data += [item['_id']]
-                    insert_data += [{'_id' : item['_id']}]
-                print(insert_data)
-                if len(delete_data) != 0 :
-                    buf.delete_many({'_id' : {'$in' : delete_data}})
-                if len(insert_data) != 0 :
-                    buf.insert_many(insert_data)
+        Parameters:
+        ----------
+        interval: Float
+            the seconds between two flushes of the timer thread
 
-            else:
-                result = self.collection.find({'_id' : {'$in' : ids}, entity : {'$lt' : self.threshold}})
+        max_events: Int
+            the number of buffered events that triggers a flush
+        """
+        return FeedbackBuffer(self.db, self.threshold, self.get_tag_collections(),
+                              interval, max_events, self.materialize_statistics, self.query_cache)
 
-                delete_data = []
+    def get_tag_collections(self):
+        """Get the cached set of existing tag index collections"""
+        if self.tag_collections is None:
+            self.tag_collections = set(self.db.list_collection_names())
 
-                for item in result:
-                    delete_data += [item['_id']]
+        return self.tag_collections
 
-                if len(delete_data) == 0 : return 
-                buf.delete_many({'_id' : {'$in' : delete_data}})
-        return
+    def rebuild_tag_index(self, tags=None):
+        """Rebuild the index collections of given tags, or of all tags, from the credits"""
+        if tags is None:
+            tags = get_all_tags(self.db)
 
+        for tag in tags:
+            if not has_tag_collection(tag):
+                print(f'Skip the index of {tag}, it is named after a reserved collection!')
+                continue
 
+            count = rebuild_tag_index(self.db, tag, self.threshold)
+            self.get_tag_collections().add(tag)
+            print(f'Index of {tag}: {count} images')
 
     def get_images(self, tags, img_type="JPEG", use_count=-1,
                    limit=10, use_cache=True, cache_version=0,
-                   next_cache_name="latest"):
+                   next_cache_name="latest", batch_size=100, workers=1, size=None,
+                   ranked=False, weights=None):
         """
         Get Image from database
 
@@ -247,104 +413,424 @@ class PicDB:
         next_cache_name: String
             the cache label for the next cache version
 
+        batch_size: Int
+            the number of images fetched in one query while downloading
+
+        workers: Int
+            the number of concurrent download threads, each holds at most
+            batch_size images in memory
+
+        size: Int
+            download renditions whose longer edge is at most size instead of
+            the originals, saved under images/renditions/{size}. Missing
+            renditions are made on this client: their originals are
+            downloaded, resized and the renditions uploaded for later calls
+
+        ranked: Bool
+            get the top limit images by their tag credits instead of any
+            matching images, see rank_images
+
+        weights: Dict[String, Number]
+            the weight of each tag credit when ranked
+
         """
         # Force user to give a label for the next cache version
         if not use_cache and next_cache_name == "latest":
             print("You have to specify a label name for new cache version!")
             return
 
-        cache_tag_dir = create_cache_dir(self.dir_path, tags)
-        version, name, cache_exists = check_cache_info(
-            self.dir_path, tags, str(cache_version))
+        images_list = get_usable_cache_images(self.dir_path, tags, cache_version, use_cache, limit)
 
-        cache_path = os.path.join(
-            cache_tag_dir, f'{version}-{name}.config')
-
-        if not use_cache or not cache_exists:
+        if images_list is None:
             # Get images from the database
-            images_list = get_images_id_from_database(
-                self.db, tags, img_type, use_count, limit)
+            images_list = self.query_images_id(tags, img_type, use_count, limit, ranked, weights,
+                                               refresh=not use_cache)
 
             print("Getting images list from database!")
 
+        if size is None:
+            pool_path, manifest = self.dir_path, self.manifest
         else:
-            # Read from local cache
-            cached_info = read_downloaded_cache(cache_path)
-            cached_list = cached_info["images_list"]
+            pool_path, manifest = self.get_rendition_pool(size)
+
+        # Filter out downloaded images to only download not downloaded ones
+        to_download_list = [image_id for image_id in images_list
+                            if image_id not in manifest]
 
-            print("Reading Cached list!")
-            print(f"{len(cached_list)} images cached!\n")
+        print(f'Find {len(to_download_list)} images to download!\n')
 
-            # Not enough cache images, find more from database
-            if(len(cached_list) < limit):
-                images_list = get_images_id_from_database(
-                    self.db, tags, img_type, use_count, limit)
-            else:
-                images_list = cached_list
+        if size is not None:
+            generated = ensure_renditions(self.db, self.storage, to_download_list, size,
+                                          batch_size=batch_size)
+            if generated:
+                print(f'Generated {generated} renditions of size {size}!\n')
 
-        # Get the list of all downloaded images
-        downloaded_list = get_downloaded_images_list(self.dir_path)
+        # Actually retrieve undownloaded images and save them based on their ids
+        count, downloaded_size, seconds = download_images(
+            self.db, pool_path, to_download_list, self.storage, workers, batch_size,
+            manifest, size)
 
-        # Filter out downloaded images to only download not downloaded ones
-        if downloaded_list:
-            to_download_list = list(set(images_list) - set(downloaded_list))
+        if count:
+            mb = downloaded_size / 2**20
+            rate = mb / seconds if seconds else float('inf')
+            print(f'Downloaded {count} images ({mb:.2f} MB) in {seconds:.2f}s, {rate:.2f} MB/s\n')
+
+        # Images requested again are used as well
+        manifest.touch([image_id for image_id in images_list
+                        if image_id not in to_download_list])
+
+        # Store latest cache info, and a new version when the database was queried
+        store_images_list(self.dir_path, tags, images_list, img_type, use_count, limit,
+                          None if use_cache else next_cache_name)
+
+        # Keep the image pool within its disk budget
+        self.evict_images()
+
+    def iter_images(self, tags, img_type="JPEG", use_count=-1, page_size=1000, token=None):
+        """
+        Iterate the ids of all images having all tags in _id order, page by page
+
+        Parameters:
+        ----------
+        page_size: Int
+            the number of ids fetched in one query
+
+        token: String
+            the token of a former iteration to resume after its last page
+
+        Returns:
+        ----------
+        iterator: TagQueryIterator
+            iterate it for ids, or pages() for lists of ids, its token
+            resumes the iteration at the id being handled, or after the
+            last yielded page
+
+        """
+        return TagQueryIterator(self.db, tags, img_type, use_count, page_size, token)
+
+    def download_all_images(self, tags, img_type="JPEG", use_count=-1, page_size=1000, token=None,
+                            batch_size=100, workers=1):
+        """
+        Download all images having all tags, page by page, in constant memory
+
+        The token printed after each page resumes the download after it, for
+        example when the download was interrupted.
+
+        Returns:
+        ----------
+        token: String
+            the token after the last downloaded page
+        """
+        iterator = self.iter_images(tags, img_type, use_count, page_size, token)
+        total_count, total_size = 0, 0
 
+        for page in iterator.pages():
+            to_download_list = [image_id for image_id in page if image_id not in self.manifest]
+            count, size, _ = download_images(
+                self.db, self.dir_path, to_download_list, self.storage, workers, batch_size,
+                self.manifest)
+            total_count, total_size = total_count + count, total_size + size
+
+            # Keep the image pool within its disk budget while walking the pages
+            self.evict_images()
+            print(f'Downloaded {total_count} images ({total_size / 2**20:.2f} MB), '
+                  f'resume token: {iterator.token}')
+
+        return iterator.token
+
+    def query_images_id(self, tags, img_type="JPEG", use_count=-1, limit=10, ranked=False, weights=None,
+                        refresh=False):
+        """
+        Get the image ids of a query from the query result cache, or from the database
+
+        With ranked, the ids are the top limit images by their weighted tag
+        credits, see rank_images.
+        """
+        order = make_rank_order(tags, weights) if ranked else None
+
+        # A refresh queries the database and replaces the cached result
+        if self.query_cache_ttl > 0 and not refresh:
+            images_list = self.query_cache.get(
+                tags, img_type, use_count, limit, self.threshold, order)
+            if images_list is not None:
+                print("Get images list from query cache!")
+                return images_list
+
+        if ranked:
+            images_list = [image_id for image_id, _ in get_ranked_images_from_database(
+                self.db, tags, img_type, use_count, limit, weights)]
         else:
-            to_download_list = images_list
+            images_list = get_images_id_from_database(
+                self.db, tags, img_type, use_count, limit, self.threshold)
 
-        print(f'Find {len(to_download_list)} images to download!\n')
+        if self.query_cache_ttl > 0:
+            self.query_cache.put(
+                tags, img_type, use_count, limit, self.threshold, images_list, order)
 
-        # Actually retrieve undownloaded images
-        download_images = get_images_content_from_database(
-            self.db, to_download_list)
+        return images_list
 
-        # Save images based on their ids
-        for image in download_images:
-            save_image(self.dir_path, image)
+    def rank_images(self, tags, img_type="JPEG", use_count=-1, limit=10, weights=None):
+        """
+        Get the top images having all tags, ranked on the server by their tag credits
 
-        # Store latest cache info
-        latest_cache_path = os.path.join(cache_tag_dir, '0-latest.config')
-        cache_info = make_cache_info(
-            images_list, tags, img_type, use_count, limit)
-        store_downloaded_cache(cache_info, latest_cache_path)
+        Parameters:
+        ----------
+        weights: Dict[String, Number]
+            the weight of each tag credit in the score, default to 1, so the
+            score is the sum of the credits
 
-        # Save new cache version in local cache diretory
-        if not use_cache:
-            next_cache_version = get_next_cache_version(self.dir_path, tags)
-            new_cache_path = os.path.join(
-                cache_tag_dir, f'{next_cache_version}-{next_cache_name}.config')
-            cache_info = make_cache_info(
-                images_list, tags, img_type, use_count, limit)
+        Returns:
+        ----------
+        ranked_list: List[(String, Number)]
+            the image ids and their scores, in descending score order
 
-            store_downloaded_cache(cache_info, new_cache_path)
+        """
+        return get_ranked_images_from_database(self.db, tags, img_type, use_count, limit, weights)
 
-    def use_images(self, tags, cache_version=0):
-        """Get images list for given tags and cache version"""
+    def query_cache_stats(self):
+        """Display and return the hits, misses, hit rate and size of the query result cache"""
+        stats = self.query_cache.get_stats()
+        print(f'Query cache: {stats["hits"]} hits, {stats["misses"]} misses, '
+              f'{stats["hit_rate"]:.1%} hit rate, {stats["size"]} results')
+
+        return stats
+
+    def get_rendition_pool(self, size):
+        """Get the directory and the manifest of the renditions of a size"""
+        rendition_path = get_rendition_dir(self.dir_path, size)
+        if size not in self.rendition_manifests:
+            os.makedirs(rendition_path, exist_ok=True)
+            self.rendition_manifests[size] = ImageManifest(
+                rendition_path, f'rendition-{size}', self.dir_path)
+
+        return rendition_path, self.rendition_manifests[size]
+
+    def build_renditions(self, sizes, tags=None, workers=None, batch_size=100):
+        """
+        Generate renditions of the given sizes for images having all tags, or all images
+
+        This can run as a background job, so later downloads of these sizes
+        only transfer the renditions.
+        """
+        query = {'tags.%s' % tag: {'$exists': True} for tag in tags or []}
+        images_list = [str(image['_id']) for image in self.collection.find(query, {'_id': 1})]
+
+        for size in sizes:
+            generated = ensure_renditions(
+                self.db, self.storage, images_list, size, workers, batch_size)
+            print(f'Generated {generated} renditions of size {size}!')
+
+    def evict_images(self, budget=None, policy=None):
+        """
+        Delete images from the image pool until it fits in the disk budget
+
+        Images of named cache versions and pinned images are kept, see ImageManifest.evict
+
+        Parameters:
+        ----------
+        budget: Int
+            the disk budget in bytes, default to pool_budget
+
+        policy: 'lru' or 'lfu'
+            the eviction order, default to eviction_policy
+        """
+        budget = self.pool_budget if budget is None else budget
+        policy = self.eviction_policy if policy is None else policy
+        if budget is None:
+            return
+
+        count, size = self.manifest.evict(budget, policy)
+        if count:
+            print(f'Evicted {count} images ({size / 2**20:.2f} MB) from the image pool!')
+        if self.manifest.total_size > budget:
+            print('The images of named cache versions and pinned images exceed the disk budget!')
+
+    def reconcile_images(self):
+        """Rebuild the manifest of downloaded images from the image pool on disk"""
+        added, removed = self.manifest.reconcile()
+        print(f'Found {added} unrecorded images and {removed} missing images!')
+        print(f'{len(self.manifest)} images in the image pool!')
+
+    def use_images(self, tags, cache_version=0, packed=False):
+        """
+        Get images list for given tags and cache version
+
+        With packed=True, return a ShardReader of the version exported by
+        export_cache(), which gives zero-copy views of the images by id.
+        """
 
         version, name, cache_exists = check_cache_info(
-            self.dir_path, tags, str(cache_version))
+            self.dir_path, tags, cache_version)
 
         if not cache_exists:
             print(f'Version: {version} -- Name: {name} not found!\n')
             print('Please download the images first!')
             return
 
-        cache_tag_dir = create_cache_dir(self.dir_path, tags)
-        cache_path = os.path.join(
-            cache_tag_dir, f'{version}-{name}.config')
+        if packed:
+            packed_path = get_packed_dir(self.dir_path, get_tags_key(tags), version)
+            if not os.path.isfile(os.path.join(packed_path, 'index.json')):
+                print(f'Version: {version} -- Name: {name} is not packed!\n')
+                print('Please export the cache first!')
+                return
+            return ShardReader(packed_path)
 
-        cache_info = read_downloaded_cache(cache_path)
+        cache_info = get_cache_info(self.dir_path, tags, version)
         cached_list = cache_info["images_list"]
+        self.manifest.touch(cached_list)
 
         return cached_list
 
-    def move_images(self, tags, dst_path, relative=True, cache_version=0):
-        """Move downloaded images of a cache version to the given user directory"""
+    def export_cache(self, tags, cache_version=0, dst_path=None, shard_size=2**30):
+        """
+        Pack the downloaded images of a cache version into a few large shard files
+
+        Parameters:
+        ----------
+        dst_path: String
+            the export directory, default to images/packed/{tags}/{version},
+            where use_images(packed=True) reads it
+
+        shard_size: Int
+            the maximum bytes of a shard file
+        """
+        version, name, cache_exists = check_cache_info(self.dir_path, tags, cache_version)
+
+        if not cache_exists:
+            print(f'Version: {version} -- Name: {name} not found!\n')
+            return
+
+        cache_info = get_cache_info(self.dir_path, tags, version)
+        if dst_path is None:
+            dst_path = get_packed_dir(self.dir_path, get_tags_key(tags), version)
+
+        count, size, missing = pack_images(
+            self.dir_path, cache_info["images_list"], cache_info["img_type"], dst_path,
+            cache_info, self.manifest, shard_size)
+
+        for image_name in missing:
+            print(f'Image: {image_name} not found!')
+
+        print(f'Packed {count} images ({size / 2**20:.2f} MB) into {dst_path}')
+
+    def import_cache(self, src_path, next_cache_name="imported"):
+        """Add the images of a packed cache version to the image pool and label them as a new cache version"""
+        with ShardReader(src_path) as reader:
+            tags = reader.index["tags"]
+            to_import_list = [image_id for image_id in reader.ids if image_id not in self.manifest]
+
+            print(f'Find {len(to_import_list)} images to import!\n')
+
+            records = []
+            for image_id in to_import_list:
+                img_type, _, digest = reader.get_info(image_id)
+                view = reader[image_id]
+                size = save_image(self.dir_path, {'_id': image_id, 'img_type': img_type,
+                                                  'content': view}, verbose=False)
+                view.release()
+                records.append((image_id, img_type, size, digest))
+            self.manifest.add_many(records)
+
+            cache_info = make_cache_info(reader.ids, tags, reader.index["img_type"],
+                                         reader.index["use_count"], reader.index["limit"])
+
+        next_version = get_next_cache_version(self.dir_path, tags)
+        store_cache_version(self.dir_path, tags, next_version, next_cache_name, cache_info)
+
+        print(f'Imported {len(records)} images as version {next_version}-{next_cache_name}!')
+
+    def load_images(self, tags, cache_version=0, batch_size=32, size=(224, 224), normalize=False,
+                    workers=None, prefetch=2, tensor_cache=False):
+        """
+        Load the downloaded images of a cache version as batches of numpy arrays
+
+        Parameters:
+        ----------
+        size: (Int, Int)
+            the (height, width) every image is resized to
+
+        normalize: Bool or (mean, std)
+            False yields uint8 batches, True scales them to float32 in [0, 1],
+            a (mean, std) pair of per channel values also standardizes them
+
+        workers: Int
+            the number of decoding processes, default to the number of CPUs
+
+        prefetch: Int
+            the number of batches decoded ahead of the consumed one
+
+        tensor_cache: Bool
+            write the decoded images into a memory-mapped .npy file under
+            images/tensors, so later epochs read it instead of decoding
+
+        Returns:
+        ----------
+        loader: ImageLoader
+            an iterable of (ids, batch), batch has shape (N, height, width, 3)
+
+        """
+        # numpy is only needed by the loader
+        from utils.loader_utils import ImageLoader, get_tensor_cache_path
+
+        images_list = self.use_images(tags, cache_version)
+        if images_list is None:
+            return
+
+        version, _, _ = check_cache_info(self.dir_path, tags, cache_version)
+        img_type = get_cache_info(self.dir_path, tags, version)["img_type"]
+
+        loaded_list = [image_id for image_id in images_list if image_id in self.manifest]
+        if len(loaded_list) < len(images_list):
+            print(f'{len(images_list) - len(loaded_list)} images are not downloaded, '
+                  f'call get_images() to download them!\n')
+
+        tensor_cache_path = None
+        if tensor_cache:
+            height, width = size
+            tensor_cache_path = get_tensor_cache_path(
+                self.dir_path, get_tags_key(tags), version, loaded_list, height, width)
+
+        return ImageLoader(self.dir_path, loaded_list, img_type, batch_size, size, normalize,
+                           workers, prefetch, tensor_cache_path)
+
+    def list_cache(self, tags):
+        """List all cache versions for given tags"""
+        list_all_cache_version(self.dir_path, tags)
+
+    def diff_cache(self, tags, version_a, version_b):
+        """Compare the images of two cache versions for given tags"""
+        only_a, only_b = diff_cache_versions(self.dir_path, tags, version_a, version_b)
+
+        print(f'{len(only_a)} images only in version {version_a}!')
+        print(f'{len(only_b)} images only in version {version_b}!')
+
+        return only_a, only_b
+
+    def move_images(self, tags, dst_path, relative=True, cache_version=0, mode='auto', workers=8):
+        """
+        Move downloaded images of a cache version to the given user directory
+
+        Parameters:
+        ----------
+        mode: 'auto', 'link', 'symlink' or 'copy'
+            'link' hard links images, 'symlink' links to the image pool,
+            'copy' copies the content in the kernel, 'auto' hard links when
+            the directory is on the same filesystem and copies otherwise.
+            A hard linked image is the same file as the pool image, so
+            editing it in place also changes the pool image: use 'copy' for
+            images you edit. Symbolic links would dangle once their pool
+            images are evicted, so symlinked images are pinned in the
+            manifest and never evicted, see ImageManifest.pin
+
+        workers: Int
+            the number of threads placing images
+        """
 
         # Get cache info
         cache_info = get_cache_info(self.dir_path, tags, cache_version)
         images_list = cache_info["images_list"]
         img_type = cache_info["img_type"]
+        self.manifest.touch(images_list)
 
         # Convert relative path to absolute path
         if relative:
@@ -360,19 +846,19 @@ class PicDB:
         print(f"Find {len(to_move_list)} images to move!")
 
         # Move downloaded images to destination directory for further user own usage
-        for image_name in to_move_list:
-            img_path = f'{image_name}.{img_type}'
-            src_image_path = get_image_path(self.dir_path, img_path)
-            dst_image_path = os.path.join(dst_path, img_path)
-            try:
-                with open(src_image_path, "rb") as f:
-                    encoded = f.read()
-
-                with open(dst_image_path, "wb") as f:
-                    f.write(encoded)
-
-            except FileNotFoundError:
-                print(f'Image: {image_name} not found!')
+        count, size, seconds, missing = move_images_to(
+            self.dir_path, to_move_list, img_type, dst_path, mode, workers)
+
+        for image_name in missing:
+            print(f'Image: {image_name} not found!')
+
+        # Keep the targets of the symbolic links in the image pool
+        if mode == 'symlink':
+            self.manifest.pin(set(to_move_list) - set(missing))
+
+        if count:
+            rate = size / 2**20 / seconds if seconds else float('inf')
+            print(f'Moved {count} images ({size / 2**20:.2f} MB) in {seconds:.2f}s, {rate:.2f} MB/s')
 
 if __name__ == '__main__':
     pic_db = PicDB()
@@ -0,0 +1,257 @@
+# Coroutine counterparts of the database helpers for AsyncPicDB. They take a
+# motor database, or any stand-in with the same awaitable API, and share
+# their query and request builders with the synchronous helpers.
+import os
+import asyncio
+from time import perf_counter
+
+from bson.objectid import ObjectId
+from pymongo.errors import CollectionInvalid
+
+from .db_utils import make_tags_filter
+from .index_utils import INDEX_SPECS
+from .image_utils import save_image, get_image_path, get_partial_path
+from .storage_utils import CONTENT_PROJECTION
+from .stats_utils import make_statistics_requests
+from .phash_utils import make_near_duplicates_query, rank_near_duplicates
+from .tag_index_utils import make_credit_requests, make_credits_query, make_tag_index_requests
+from .tag_index_utils import has_tag_collection
+
+
+async def get_images_id_from_database(db, tags, img_type, use_count, limit, threshold=100):
+    """Get image id list from database given some conditions, see db_utils.get_images_id_from_database"""
+    if limit <= 0:
+        return []
+
+    coll = db.images
+
+    result = coll.find(
+        make_tags_filter(tags, img_type, use_count, threshold), {"_id": 1}, limit=limit)
+    id_list = [image['_id'] async for image in result]
+
+    if len(id_list) < limit:
+        query = make_tags_filter(tags, img_type, use_count)
+        query["_id"] = {"$nin": id_list}
+
+        result = coll.find(query, {"_id": 1}, limit=limit - len(id_list))
+        id_list += [image['_id'] async for image in result]
+
+    return [str(id) for id in id_list]
+
+
+async def iter_images_content_from_database(db, images_list, batch_size=100):
+    """Yield images content based on given image id list, batch by batch"""
+    coll = db.images
+
+    for i in range(0, len(images_list), batch_size):
+        id_list = [ObjectId(id) for id in images_list[i:i + batch_size]]
+        images = coll.find(
+            {"_id": {"$in": id_list}}, CONTENT_PROJECTION, batch_size=batch_size)
+
+        async for image in images:
+            yield image
+
+
+async def get_images_content_from_database(db, images_list):
+    """Get images content, or the reference to their chunked content, based on given image id list"""
+    return [image async for image in iter_images_content_from_database(db, images_list)]
+
+
+async def find_image_by_digest(db, digest):
+    """Find the id of an image with the given content digest, None if not exist"""
+    image = await db.images.find_one({"digest": digest}, {"_id": 1})
+
+    return image['_id'] if image is not None else None
+
+
+async def find_near_duplicate_images(db, value, radius):
+    """Find images whose hash is within radius of value, see phash_utils.find_near_duplicate_images"""
+    candidates = db.images.find(make_near_duplicates_query(value, radius), {"phash": 1})
+
+    return rank_near_duplicates(value, radius, [image async for image in candidates])
+
+
+async def ensure_indexes(db, specs=INDEX_SPECS):
+    """Create the indexes given by the specs, existing indexes are left untouched"""
+    created = []
+
+    for collection, indexes in specs.items():
+        for spec in indexes:
+            options = dict(spec)
+            keys = options.pop("keys")
+            created.append(await db[collection].create_index(keys, **options))
+
+    return created
+
+
+async def apply_tag_deltas(db, tag_deltas, threshold, known_collections):
+    """Change tag credits of images and keep the per-tag index collections in sync, see tag_index_utils.apply_tag_deltas"""
+    for tag in tag_deltas:
+        if tag in known_collections or not has_tag_collection(tag):
+            continue
+        try:
+            await db.create_collection(tag)
+        except CollectionInvalid:
+            pass
+        known_collections.add(tag)
+
+    credit_requests = make_credit_requests(tag_deltas)
+    if not credit_requests:
+        return 0, 0
+
+    await db.images.bulk_write(credit_requests, ordered=False)
+
+    query, projection = make_credits_query(tag_deltas)
+    credits = {image['_id']: image.get('tags', {})
+               async for image in db.images.find(query, projection)}
+
+    added, removed = 0, 0
+    for tag, requests in make_tag_index_requests(tag_deltas, credits, threshold).items():
+        result = await db[tag].bulk_write(requests, ordered=False)
+        added += result.upserted_count
+        removed += result.deleted_count
+
+    return added, removed
+
+
+async def increment_statistics(db, logs):
+    """Count newly inserted logs into the materialized statistics collection"""
+    requests = make_statistics_requests(logs)
+    if requests:
+        await db.stats.bulk_write(requests, ordered=False)
+
+
+class AsyncChunkedStorage:
+    """
+    Store small images inline and large images in GridFS chunks, with coroutines.
+
+    The layout is the same as storage_utils.ChunkedStorage, so both clients
+    read each other's images. The GridFS bucket is only opened for images
+    larger than inline_limit.
+    """
+
+    def __init__(self, db, inline_limit=4 * 2**20, bucket_name="blobs"):
+        self.db = db
+        self.inline_limit = inline_limit
+        self.bucket_name = bucket_name
+        self.bucket = None
+
+    def get_bucket(self):
+        if self.bucket is None:
+            from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+            self.bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name=self.bucket_name)
+
+        return self.bucket
+
+    async def put(self, image, content):
+        """Attach the content to an image document before it is inserted"""
+        if len(content) <= self.inline_limit:
+            image["content"] = content
+        else:
+            image["blob_id"] = await self.get_bucket().upload_from_stream(
+                image.get("digest", "image"), content,
+                metadata={"img_type": image.get("img_type")})
+        image["size"] = len(content)
+
+        return image
+
+    async def delete(self, image):
+        """Remove the content stored outside of an image document"""
+        if "blob_id" in image:
+            await self.get_bucket().delete(image["blob_id"])
+
+    async def read(self, image):
+        """Get the whole content of an image document"""
+        if "blob_id" not in image:
+            return image["content"]
+
+        stream = await self.get_bucket().open_download_stream(image["blob_id"])
+
+        return await stream.read()
+
+    async def write(self, image, f):
+        """Write the content of an image document to a file object on the default executor, return the written size"""
+        loop = asyncio.get_running_loop()
+        if "blob_id" not in image:
+            await loop.run_in_executor(None, f.write, image["content"])
+            return len(image["content"])
+
+        # Stream chunk by chunk instead of materializing the whole blob
+        stream = await self.get_bucket().open_download_stream(image["blob_id"])
+        size = 0
+        chunk = await stream.readchunk()
+        while chunk:
+            await loop.run_in_executor(None, f.write, chunk)
+            size += len(chunk)
+            chunk = await stream.readchunk()
+
+        return size
+
+
+async def save_image_async(dir_path, image, storage):
+    """
+    Save an image to the image pool, return the size.
+
+    Inline content is saved on the default executor in one call, chunked
+    content is streamed into the file chunk by chunk. Like save_image, the
+    file is written under a temporary name and atomically renamed.
+    """
+    loop = asyncio.get_running_loop()
+    if "blob_id" not in image:
+        return await loop.run_in_executor(None, save_image, dir_path, image, None, False)
+
+    path = get_image_path(dir_path, f'{image["_id"]}.{image["img_type"]}')
+    partial_path = get_partial_path(path)
+    await loop.run_in_executor(None, lambda: os.makedirs(os.path.dirname(path), exist_ok=True))
+
+    f = await loop.run_in_executor(None, open, partial_path, "wb")
+    try:
+        try:
+            size = await storage.write(image, f)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        await loop.run_in_executor(None, os.replace, partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    return size
+
+
+async def download_images(db, dir_path, images_list, storage, workers=1, batch_size=100, manifest=None):
+    """
+    Download images into the image pool, see download_utils.download_images.
+
+    Shards of batch_size images are downloaded by at most workers concurrent
+    tasks, and files are written on the default executor so the event loop
+    is never blocked by the disk.
+
+    Returns:
+    ----------
+    (count, size, seconds):
+        the number of downloaded images, their total bytes and the elapsed time
+
+    """
+    semaphore = asyncio.Semaphore(workers)
+    loop = asyncio.get_running_loop()
+
+    async def download_shard(shard):
+        async with semaphore:
+            records = []
+            async for image in iter_images_content_from_database(db, shard, batch_size):
+                size = await save_image_async(dir_path, image, storage)
+                records.append((image['_id'], image['img_type'], size, image.get('digest')))
+
+            if manifest is not None:
+                await loop.run_in_executor(None, manifest.add_many, records)
+
+            return len(records), sum(record[2] for record in records)
+
+    start = perf_counter()
+    results = await asyncio.gather(*[
+        download_shard(images_list[i:i + batch_size])
+        for i in range(0, len(images_list), batch_size)])
+    seconds = perf_counter() - start
+
+    return sum(count for count, _ in results), sum(size for _, size in results), seconds
@@ -1,5 +1,24 @@
 import os
 import pickle
+from time import time
+
+from .catalog_utils import get_catalog, catalog_lock
+
+
+# Image stores whose pickled caches are already migrated into the catalog
+migrated_stores = set()
+
+
+def get_cache_catalog(dir_path):
+    """Open the local catalog, migrating pickled caches on first use"""
+    conn = get_catalog(dir_path)
+
+    with catalog_lock:
+        if dir_path not in migrated_stores:
+            migrate_pickle_caches(conn, dir_path)
+            migrated_stores.add(dir_path)
+
+    return conn
 
 
 def create_cache_dir(dir_path, tags):
@@ -28,28 +47,12 @@ def get_cache_dir(dir_path):
 
 def get_cache_tag_dir(cache_dir, tags):
     """Get tags cache directory path"""
-    return os.path.join(cache_dir, '-'.join(sorted(tags)))
-
+    return os.path.join(cache_dir, get_tags_key(tags))
 
-def get_metadata_path(dir_path, tags, path):
-    return os.path.join(dir_path, path, '-'.join(sorted(tags)))
 
-
-def get_cache_path(dir_path, tags):
-    return get_metadata_path(dir_path, tags, "cache")
-
-
-def get_etl_path(dir_path, tags):
-    return get_metadata_path(dir_path, tags, 'etl')
-
-
-def get_cache_file_path(dir_path, tags, version, name):
-    """Get the cache file path given tags, version and name"""
-    cache_tag_dir = get_cache_path(dir_path, tags)
-    cache_path = os.path.join(
-        cache_tag_dir, f'{version}-{name}.config')
-
-    return cache_path
+def get_tags_key(tags):
+    """Get the key of a tags combination, which does not depend on the tags order"""
+    return '-'.join(sorted(tags))
 
 
 def make_cache_info(images_list, tags, img_type, use_count, limit):
@@ -65,6 +68,33 @@ def make_cache_info(images_list, tags, img_type, use_count, limit):
     return cache_info
 
 
+def store_cache_version(dir_path, tags, version, name, cache_info):
+    """Store cache info as the given version and label in the catalog, replacing the old one"""
+    conn = get_cache_catalog(dir_path)
+    tags_key = get_tags_key(tags)
+
+    with catalog_lock, conn:
+        insert_cache_version(conn, tags_key, int(version), name, cache_info)
+
+
+def insert_cache_version(conn, tags_key, version, name, cache_info):
+    """Insert a cache version into an opened catalog, the caller commits"""
+    images_list = cache_info["images_list"]
+
+    conn.execute(
+        'DELETE FROM cache_images WHERE tags = ? AND version = ?', (tags_key, version))
+    conn.execute(
+        'INSERT OR REPLACE INTO cache_versions '
+        '(tags, version, name, img_type, use_count, "limit", size, created) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (tags_key, version, name, cache_info["img_type"], cache_info["use_count"],
+         cache_info["limit"], len(images_list), time()))
+    conn.executemany(
+        'INSERT INTO cache_images (tags, version, position, image_id) VALUES (?, ?, ?, ?)',
+        ((tags_key, version, position, str(image_id))
+         for position, image_id in enumerate(images_list)))
+
+
 def get_cache_info(dir_path, tags, cache_version):
     """
     Get cache information provided tags and cache_version
@@ -75,85 +105,153 @@ def get_cache_info(dir_path, tags, cache_version):
         includes images id list, tags, img_type, use_count and limit
 
     """
-    version_name_list = get_all_cache_version(dir_path, tags)
+    conn = get_cache_catalog(dir_path)
+    tags_key = get_tags_key(tags)
+
+    row = conn.execute(
+        'SELECT img_type, use_count, "limit" FROM cache_versions WHERE tags = ? AND version = ?',
+        (tags_key, int(cache_version))).fetchone()
+
+    if row is None:
+        return {}
+
+    img_type, use_count, limit = row
+
+    return make_cache_info(get_cache_images(dir_path, tags, cache_version),
+                           tags, img_type, use_count, limit)
 
-    for version, name in version_name_list:
-        if version == str(cache_version):
-            cache_path = os.path.join(
-                dir_path, 'cache', '-'.join(sorted(tags)), f'{version}-{name}.config')
 
-            with open(cache_path, "rb") as f:
-                downloaded_cache = pickle.load(f)
+def get_cache_images(dir_path, tags, cache_version):
+    """Get the images id list of a cache version"""
+    conn = get_cache_catalog(dir_path)
 
-            return downloaded_cache
+    result = conn.execute(
+        'SELECT image_id FROM cache_images WHERE tags = ? AND version = ? ORDER BY position',
+        (get_tags_key(tags), int(cache_version)))
 
-    return {}
+    return [image_id for image_id, in result]
 
 
 def check_cache_info(dir_path, tags, cache_version):
     """Use version to find cache, if exist, return that version, else default to 0-latest"""
-    version_name_list = get_all_cache_version(dir_path, tags)
+    conn = get_cache_catalog(dir_path)
 
-    for version, name in version_name_list:
-        # Find a matched version
-        if version == cache_version:
-            # print(f'Find cache version: {version} -- name: {name}\n')
-            return version, name, True
+    row = conn.execute(
+        'SELECT version, name FROM cache_versions WHERE tags = ? AND version = ?',
+        (get_tags_key(tags), int(cache_version))).fetchone()
+
+    # Find a matched version
+    if row is not None:
+        version, name = row
+        return str(version), name, True
 
     # Not found, return the latest version
     return 0, "latest", False
 
 
+def get_usable_cache_images(dir_path, tags, cache_version, use_cache, limit):
+    """
+    Get the images list of a cache version if get_images can use it
+
+    None tells get_images to query the database: use_cache is False, the
+    version does not exist, or it holds fewer than limit images.
+    """
+    if not use_cache:
+        return None
+
+    version, _, cache_exists = check_cache_info(dir_path, tags, cache_version)
+    if not cache_exists:
+        return None
+
+    cached_list = get_cache_images(dir_path, tags, version)
+
+    print("Reading Cached list!")
+    print(f"{len(cached_list)} images cached!\n")
+
+    # Not enough cache images, find more from database
+    if len(cached_list) < limit:
+        return None
+
+    return cached_list
+
+
+def store_images_list(dir_path, tags, images_list, img_type, use_count, limit, next_cache_name=None):
+    """Store the images list of a query as the latest cache version, and as a new version labeled next_cache_name if given"""
+    cache_info = make_cache_info(images_list, tags, img_type, use_count, limit)
+    store_cache_version(dir_path, tags, 0, "latest", cache_info)
+
+    # Save new cache version in local cache catalog
+    if next_cache_name is not None:
+        next_cache_version = get_next_cache_version(dir_path, tags)
+        store_cache_version(dir_path, tags, next_cache_version, next_cache_name, cache_info)
+
+
 def get_all_cache_version(dir_path, tags):
     """Get a version-label list of cache name for given tags"""
-    try:
-        tags_path = '-'.join(sorted(tags))
-        cache_tag_dir = os.path.join(
-            dir_path, 'cache', tags_path)
-
-        sorted_dir_list = sorted([path.split('.')[0]
-                                  for path in os.listdir(cache_tag_dir)])
+    conn = get_cache_catalog(dir_path)
 
-        version_name_list = [path.split('-') for path in sorted_dir_list]
+    result = conn.execute(
+        'SELECT version, name FROM cache_versions WHERE tags = ? ORDER BY version',
+        (get_tags_key(tags),))
 
-        return version_name_list
-    except FileNotFoundError:
-        print("You had never download images!")
-        return
+    return [[str(version), name] for version, name in result]
 
 
 def list_all_cache_version(dir_path, tags):
     """List all cache version for some given tags"""
-    try:
-        version_name_list = get_all_cache_version(dir_path, tags)
+    conn = get_cache_catalog(dir_path)
+
+    result = conn.execute(
+        'SELECT version, name, size FROM cache_versions WHERE tags = ? ORDER BY version',
+        (get_tags_key(tags),)).fetchall()
 
-        tags_label = ' '.join(tags)
-        if len(version_name_list) == 0:
-            print(f'No Cache for [{tags_label}] now!')
-            return
+    tags_label = ' '.join(tags)
+    if len(result) == 0:
+        print(f'No Cache for [{tags_label}] now!')
+        return
 
-        print(f"Cache for [{tags_label}]: ")
-        for version, name in version_name_list:
-            print(f'Version: {version} -- Name: {name}')
-    except TypeError:
-        print(f'You had never create cache for these tags!')
+    print(f"Cache for [{tags_label}]: ")
+    for version, name, size in result:
+        print(f'Version: {version} -- Name: {name} -- Images: {size}')
 
 
-def get_next_cache_version(dir_path, tags):
-    """Get the next cache version, which is the next integer of the newest cache version in the directory now"""
-    version_name_list = get_all_cache_version(dir_path, tags)
+def diff_cache_versions(dir_path, tags, version_a, version_b):
+    """
+    Compare the images of two cache versions in the catalog
 
-    return len(version_name_list)
+    Returns:
+    ==========
+    (only_a, only_b): (List[String], List[String])
+        the images only in version_a and the images only in version_b
 
+    """
+    conn = get_cache_catalog(dir_path)
+    tags_key = get_tags_key(tags)
 
-def store_downloaded_cache(store_cache, cache_file_path):
-    """Store cache on given path"""
-    with open(cache_file_path, "wb") as f:  # Pickling
-        pickle.dump(store_cache, f)
+    query = ('SELECT image_id FROM cache_images WHERE tags = ? AND version = ? '
+             'EXCEPT SELECT image_id FROM cache_images WHERE tags = ? AND version = ?')
+
+    only_a = [image_id for image_id, in conn.execute(
+        query, (tags_key, int(version_a), tags_key, int(version_b)))]
+    only_b = [image_id for image_id, in conn.execute(
+        query, (tags_key, int(version_b), tags_key, int(version_a)))]
+
+    return only_a, only_b
+
+
+def get_next_cache_version(dir_path, tags):
+    """Get the next cache version, which is the next integer of the newest cache version in the catalog now"""
+    conn = get_cache_catalog(dir_path)
+
+    version, = conn.execute(
+        'SELECT COALESCE(MAX(version), 0) FROM cache_versions WHERE tags = ?',
+        (get_tags_key(tags),)).fetchone()
+
+    return version + 1
 
 
 def read_downloaded_cache(cache_file_path):
-    """Read downloaded cache on given path"""
+    """Read a pickled cache file written by former versions"""
     if not os.path.isfile(cache_file_path):
         return []
 
@@ -161,3 +259,31 @@ def read_downloaded_cache(cache_file_path):
         downloaded_cache = pickle.load(f)
 
     return downloaded_cache
+
+
+def migrate_pickle_caches(conn, dir_path):
+    """Import the {version}-{name}.config pickles of former versions into the catalog"""
+    cache_dir = get_cache_dir(dir_path)
+    migrated = 0
+
+    for tags_key in os.listdir(cache_dir):
+        cache_tag_dir = os.path.join(cache_dir, tags_key)
+        if not os.path.isdir(cache_tag_dir):
+            continue
+
+        for filename in os.listdir(cache_tag_dir):
+            if not filename.endswith('.config'):
+                continue
+
+            version, name = filename[:-len('.config')].split('-', 1)
+            cache_path = os.path.join(cache_tag_dir, filename)
+            cache_info = read_downloaded_cache(cache_path)
+
+            with conn:
+                insert_cache_version(conn, tags_key, int(version), name, cache_info)
+            # Keep the file, but never import it again
+            os.replace(cache_path, cache_path + '.migrated')
+            migrated += 1
+
+    if migrated:
+        print(f'Migrated {migrated} cache versions into the catalog!')
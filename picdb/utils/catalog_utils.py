@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+
+
+CATALOG_NAME = 'catalog.sqlite3'
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache_versions (
+    tags TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    img_type TEXT,
+    use_count INTEGER,
+    "limit" INTEGER,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (tags, version)
+);
+
+CREATE TABLE IF NOT EXISTS cache_images (
+    tags TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (tags, version, position)
+);
+
+CREATE INDEX IF NOT EXISTS cache_images_image_id ON cache_images (image_id);
+
+CREATE TABLE IF NOT EXISTS pool_images (
+    pool TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    img_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    mtime REAL NOT NULL,
+    last_access REAL NOT NULL DEFAULT 0,
+    access_count INTEGER NOT NULL DEFAULT 0,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (pool, image_id)
+);
+
+CREATE TABLE IF NOT EXISTS query_results (
+    key TEXT PRIMARY KEY,
+    tags TEXT NOT NULL,
+    images TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+# Columns added after their table was released, created on older catalogs
+CATALOG_COLUMNS = [
+    ('pool_images', 'last_access', 'REAL NOT NULL DEFAULT 0'),
+    ('pool_images', 'access_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('pool_images', 'pinned', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+CATALOG_INDEXES = '''
+CREATE INDEX IF NOT EXISTS pool_images_lru ON pool_images (pool, last_access);
+CREATE INDEX IF NOT EXISTS pool_images_lfu ON pool_images (pool, access_count, last_access);
+'''
+
+# Opened catalogs by path, the connections are shared by all threads
+catalogs = {}
+
+# Serialize writes of the shared connections
+catalog_lock = threading.RLock()
+
+
+def get_catalog_path(dir_path):
+    """Get the local catalog path, which is kept in the cache directory"""
+    return os.path.join(dir_path, 'cache', CATALOG_NAME)
+
+
+def get_catalog(dir_path):
+    """Open the local catalog of the given image store, create it if not exist"""
+    catalog_path = get_catalog_path(dir_path)
+
+    with catalog_lock:
+        if catalog_path not in catalogs:
+            os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+
+            conn = sqlite3.connect(catalog_path, check_same_thread=False)
+            # Readers of other processes are not blocked by a writer
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(CATALOG_SCHEMA)
+            upgrade_catalog(conn)
+            conn.executescript(CATALOG_INDEXES)
+
+            catalogs[catalog_path] = conn
+
+    return catalogs[catalog_path]
+
+
+def upgrade_catalog(conn):
+    """Add the columns missing from a catalog created by a former version"""
+    for table, column, definition in CATALOG_COLUMNS:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    conn.commit()
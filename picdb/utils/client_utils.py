@@ -0,0 +1,58 @@
+import os
+
+from .dir_utils import get_home_path, get_store_path, get_dir_path
+from .image_utils import migrate_pool_layout
+from .manifest_utils import ImageManifest
+from .catalog_utils import get_catalog
+from .query_cache_utils import QueryResultCache
+
+
+class PicDBBase:
+    """
+    Settings and local state shared by PicDB and AsyncPicDB.
+
+    The settings are declared once here, so both clients accept the same
+    ones. init_store() opens the local image store, which needs no database
+    connection.
+    """
+
+    def __init__(self):
+        self.db_name = 'picdb'
+        self.db_collection = 'images'
+        self.db_log_collection = 'logs'
+        self.threshold = 100
+        self.tag_collections = None
+        # Keep tag and user counts in the stats collection on upload and feedback
+        self.materialize_statistics = False
+        # Disk budget of the image pool in bytes, None for unbounded
+        self.pool_budget = None
+        # Eviction policy of the image pool, 'lru' or 'lfu'
+        self.eviction_policy = 'lru'
+        # Cached image id queries and their time to live in seconds, 0 to disable
+        self.query_cache_size = 1024
+        self.query_cache_ttl = 60.0
+        # Share cached queries with other processes through the local catalog
+        self.shared_query_cache = False
+        # Skip uploads within this perceptual hash distance of an image, None to only skip exact copies
+        self.near_duplicate_radius = None
+
+    def init_store(self):
+        """Open the image pool of the user, its manifest and the query result cache"""
+        self.home_path = get_home_path()
+        self.store_path = get_store_path(self.home_path)
+        self.dir_path = get_dir_path(self.store_path)
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        # Images of the former flat layout are moved into their shards once
+        moved = migrate_pool_layout(self.dir_path)
+        if moved:
+            print(f'Moved {moved} images into the sharded image pool!')
+
+        # The downloaded images of the image pool
+        self.manifest = ImageManifest(self.dir_path)
+        # The downloaded renditions of each size
+        self.rendition_manifests = {}
+
+        self.query_cache = QueryResultCache(
+            self.query_cache_size, self.query_cache_ttl,
+            get_catalog(self.dir_path) if self.shared_query_cache else None)
@@ -1,10 +1,150 @@
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+from .image_utils import get_image_digest
+from .storage_utils import CONTENT_PROJECTION
+from .tag_index_utils import has_tag_collection
 
-def get_images_id_from_database(db, tags, img_type, use_count, limit):
+
+def make_tags_filter(tags, img_type, use_count, min_credit=None):
+    """
+    Make the images filter matching all given tags.
+
+    An image matches a tag when it has a credit for that tag, or when the
+    credit is at least min_credit if given.
+    """
+    query = {"img_type": img_type, "use_count": {"$gt": use_count}}
+
+    for tag in tags:
+        tag_str = 'tags.%s' % tag
+        if min_credit is None:
+            query[tag_str] = {"$exists": True}
+        else:
+            query[tag_str] = {"$gte": min_credit}
+
+    return query
+
+
+def get_images_id_from_database(db, tags, img_type, use_count, limit, threshold=100):
     """
     Get image id list from database given some conditions.
 
+    The tag intersection, filters and limit are pushed down into the images
+    query, so at most limit ids are transferred.
+
+    Parameters:
+    ----------
+    tags: 
+        the tags to select image
+
+    img_type:
+        jpg or png
+
+    use_count:
+        the use count threshould for this query
+
+    limit:
+        the maximal images number to return
+
+    threshold:
+        the credit from which an image is in the index of a tag
+
+    Returns:
+    ----------
+    images_list:
+        the images list given those conditions
+
+    """
+    # limit(0) would mean no limit, there is nothing to fetch
+    if limit <= 0:
+        return []
+
+    coll = db.images
+
+    # First find images in the index of every tag, that is whose credits
+    # reach the threshold, the same condition the per-tag collections keep
+    result = coll.find(
+        make_tags_filter(tags, img_type, use_count, threshold), {"_id": 1}).limit(limit)
+    id_list = [image['_id'] for image in result]
+
+    # Second, check whether we have to fetch more images from default image pool
+    if len(id_list) >= limit:
+        print("Get images from index!")
+
+    else:
+        print("Not enough images from index!")
+        print("Try to find more in the default image pool!")
+        query = make_tags_filter(tags, img_type, use_count)
+        query["_id"] = {"$nin": id_list}
+
+        result = coll.find(query, {"_id": 1}).limit(limit - len(id_list))
+        id_list += [image['_id'] for image in result]
+
+    images_list = [str(id) for id in id_list]
+
+    return images_list
+
+
+def make_ranked_pipeline(tags, img_type, use_count, limit, weights=None):
+    """
+    Make the aggregation ranking images having all tags by their credits.
+
+    The score is the sum of the tag credits, each multiplied by its weight
+    in weights, default to 1.
+
+    A single tag is sorted on its credit field alone, the only sort the
+    wildcard index of tags can serve, so equal credits come in index order
+    rather than _id order. Several tags are sorted on the computed score,
+    which no index serves: the server scans every matching image in a
+    blocking sort, and only keeps the top limit in memory since $sort is
+    followed by $limit. Equal scores come in _id order.
+    """
+    weights = {tag: (weights or {}).get(tag, 1) for tag in tags}
+    pipeline = [{"$match": make_tags_filter(tags, img_type, use_count)}]
+
+    if len(tags) == 1 and weights[tags[0]] > 0:
+        credit = 'tags.%s' % tags[0]
+        return pipeline + [
+            {"$sort": {credit: -1}},
+            {"$limit": limit},
+            {"$project": {"_id": 1, "score": {"$multiply": [weights[tags[0]], "$" + credit]}}}
+        ]
+
+    score = {"$add": [{"$multiply": [weight, {"$ifNull": ["$tags.%s" % tag, 0]}]}
+                      for tag, weight in weights.items()]}
+
+    return pipeline + [
+        {"$project": {"_id": 1, "score": score}},
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": limit}
+    ]
+
+
+def get_ranked_images_from_database(db, tags, img_type, use_count, limit, weights=None):
+    """
+    Get the top limit images having all tags, ranked by their weighted tag credits.
+
+    Returns:
+    ----------
+    ranked_list: List[(String, Number)]
+        the image ids and their scores, in descending score order
+
+    """
+    result = db.images.aggregate(
+        make_ranked_pipeline(tags, img_type, use_count, limit, weights))
+
+    return [(str(image['_id']), image['score']) for image in result]
+
+
+def get_images_id_from_tag_collections(db, tags, img_type, use_count, limit):
+    """
+    Get image id list from database given some conditions.
+
+    This is the former query path, which pulls every id of the per-tag index
+    collections and intersects them in Python. It is kept for benchmarking
+    against get_images_id_from_database.
+
     Parameters:
     ----------
     tags: 
@@ -29,6 +169,9 @@ def get_images_id_from_database(db, tags, img_type, use_count, limit):
     all_tags_list = []
 
     for tag in tags:
+        if not has_tag_collection(tag):
+            all_tags_list.append([])
+            continue
         coll = db[tag]
 
         raw_result = coll.find({})
@@ -47,7 +190,7 @@ def get_images_id_from_database(db, tags, img_type, use_count, limit):
     # Second, check whether we have to fetch more images from default image pool
     if len(id_list) >= limit:
         print("Get images from index!")
-        images_list = id_list[:limit]
+        images_list = list(id_list)[:limit]
 
     else:
         print("Not enough images from index!")
@@ -76,12 +219,89 @@ def get_images_id_from_database(db, tags, img_type, use_count, limit):
 
 
 def get_images_content_from_database(db, images_list):
-    """Get images content based on given image id list"""
-    id_list = [ObjectId(id) for id in images_list]
+    """Get images content, or the reference to their chunked content, based on given image id list"""
+    images_list = [image for image in iter_images_content_from_database(db, images_list)]
+
+    return images_list
+
+
+def iter_images_content_from_database(db, images_list, batch_size=100):
+    """
+    Yield images content based on given image id list, batch by batch.
+
+    Only one batch of documents is held in memory at a time, so the memory
+    usage is bounded by batch_size instead of the number of images.
+
+    Parameters:
+    ----------
+    images_list:
+        the image id list to fetch
+
+    batch_size:
+        the number of images fetched in one query and one cursor batch
+
+    """
+    coll = db.images
+
+    for i in range(0, len(images_list), batch_size):
+        id_list = [ObjectId(id) for id in images_list[i:i + batch_size]]
+        images = coll.find(
+            {"_id": {"$in": id_list}}, CONTENT_PROJECTION).batch_size(batch_size)
+
+        for image in images:
+            yield image
+
+
+def find_image_by_digest(db, digest):
+    """Find the id of an image with the given content digest, None if not exist"""
+    image = db.images.find_one({"digest": digest}, {"_id": 1})
+
+    return image['_id'] if image is not None else None
+
+
+def backfill_images_digest(db, batch_size=500):
+    """
+    Compute and store the content digest of images uploaded without one.
+
+    Parameters:
+    ----------
+    batch_size:
+        the number of documents to update in one bulk write
+
+    Returns:
+    ----------
+    (updated, duplicated):
+        the number of updated images and the number of images whose content
+        already exists under another id
+
+    """
     coll = db.images
     images = coll.find(
-        {"_id": {"$in": id_list}}, {"content": 1, "img_type": 1})
+        {"digest": {"$exists": False}}, {"content": 1}).batch_size(batch_size)
 
-    images_list = [image for image in images]
+    updated, duplicated = 0, 0
+    requests = []
 
-    return images_list
+    def flush(requests):
+        try:
+            result = coll.bulk_write(requests, ordered=False)
+            return result.modified_count, 0
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            return e.details["nModified"], len(errors)
+
+    for image in images:
+        digest = get_image_digest(image['content'])
+        requests.append(
+            UpdateOne({"_id": image['_id']}, {"$set": {"digest": digest}}))
+
+        if len(requests) >= batch_size:
+            n_updated, n_duplicated = flush(requests)
+            updated, duplicated = updated + n_updated, duplicated + n_duplicated
+            requests = []
+
+    if requests:
+        n_updated, n_duplicated = flush(requests)
+        updated, duplicated = updated + n_updated, duplicated + n_duplicated
+
+    return updated, duplicated
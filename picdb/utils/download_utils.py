@@ -0,0 +1,71 @@
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .db_utils import iter_images_content_from_database
+from .image_utils import save_image
+from .rendition_utils import iter_renditions_from_database
+
+
+def download_images(db, dir_path, images_list, storage, workers=1, batch_size=100, manifest=None,
+                    max_edge=None):
+    """
+    Download images of the given id list into the image pool.
+
+    The id list is split into shards of batch_size, each shard is fetched with
+    one query and written by one of the worker threads, so at most
+    workers * batch_size images are held in memory.
+
+    Parameters:
+    ----------
+    workers:
+        the number of download threads, 1 downloads sequentially
+
+    batch_size:
+        the number of images in one shard
+
+    manifest:
+        the manifest of the image pool, updated after each shard
+
+    max_edge:
+        download the renditions of this size instead of the originals
+
+    Returns:
+    ----------
+    (count, size, seconds):
+        the number of downloaded images, their total bytes and the elapsed time
+
+    """
+    verbose = workers == 1
+
+    def download_shard(shard):
+        records = []
+        if max_edge is None:
+            images = iter_images_content_from_database(db, shard, batch_size)
+        else:
+            images = iter_renditions_from_database(db, shard, max_edge, batch_size)
+
+        for image in images:
+            image_size = save_image(dir_path, image, storage, verbose)
+            records.append((image['_id'], image['img_type'], image_size, image.get('digest')))
+
+        if manifest is not None:
+            manifest.add_many(records)
+
+        return len(records), sum(record[2] for record in records)
+
+    shards = [images_list[i:i + batch_size]
+              for i in range(0, len(images_list), batch_size)]
+
+    start = perf_counter()
+    if workers == 1:
+        results = [download_shard(shard) for shard in shards]
+    else:
+        # pymongo clients are thread-safe and share one connection pool
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(download_shard, shards))
+    seconds = perf_counter() - start
+
+    count = sum(result[0] for result in results)
+    size = sum(result[1] for result in results)
+
+    return count, size, seconds
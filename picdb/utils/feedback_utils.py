@@ -0,0 +1,119 @@
+import threading
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from .tag_index_utils import apply_tag_deltas
+from .stats_utils import increment_statistics
+
+
+class FeedbackBuffer:
+    """
+    Accumulate feedback events in memory and write them in bulk.
+
+    Repeated feedback on the same image and tag is coalesced into one credit
+    change. Events are flushed when the buffer holds max_events of them, every
+    interval seconds by a daemon timer thread, on flush(), and on close() or
+    when leaving a with block, so no events are lost on shutdown.
+
+    Cached query results of the flushed tags are invalidated, if a
+    QueryResultCache is given.
+    """
+
+    def __init__(self, db, threshold, known_collections, interval=1.0, max_events=10000,
+                 materialize_statistics=False, query_cache=None):
+        self.db = db
+        self.threshold = threshold
+        self.known_collections = known_collections
+        self.interval = interval
+        self.max_events = max_events
+        self.materialize_statistics = materialize_statistics
+        self.query_cache = query_cache
+
+        self.lock = threading.Lock()
+        self.tag_deltas = {}
+        self.tag_logs = {}
+        self.events = 0
+
+        # Flush idle buffers too, not only when the next event arrives
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.flush_periodically, daemon=True)
+        self.timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush_periodically(self):
+        """Flush the buffer every interval seconds until it is closed"""
+        while not self.closed.wait(self.interval):
+            try:
+                self.flush()
+            except PyMongoError as e:
+                print(f'Cannot flush feedback events: {e}')
+
+    def close(self):
+        """Stop the timer thread and flush the remaining events"""
+        self.closed.set()
+        self.timer.join()
+        return self.flush()
+
+    def add(self, user, tag, image_id, positive_feedback):
+        """Record one feedback event"""
+        self.add_many(user, [tag], [image_id], positive_feedback)
+
+    def add_many(self, user, tags, ids, positive_feedback):
+        """Record feedback events of the given user for every tag and image id"""
+        value = 1 if positive_feedback else -1
+        ids = [ObjectId(id) for id in ids]
+
+        with self.lock:
+            for tag in tags:
+                deltas = self.tag_deltas.setdefault(tag, {})
+                for id in ids:
+                    deltas[id] = deltas.get(id, 0) + value
+
+                if positive_feedback:
+                    self.tag_logs.setdefault((tag, user), set()).update(ids)
+
+            self.events += len(tags) * len(ids)
+            should_flush = self.events >= self.max_events
+
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered events, return the number of flushed events"""
+        with self.lock:
+            tag_deltas, tag_logs, events = self.tag_deltas, self.tag_logs, self.events
+            self.tag_deltas, self.tag_logs, self.events = {}, {}, 0
+
+            if events == 0:
+                return 0
+
+            apply_tag_deltas(self.db, tag_deltas, self.threshold, self.known_collections)
+            if self.query_cache is not None:
+                self.query_cache.invalidate_tags(tag_deltas)
+
+            logs = make_feedback_logs(tag_logs)
+            if logs:
+                result = self.db.logs.bulk_write(make_log_requests(logs), ordered=False)
+
+                if self.materialize_statistics:
+                    increment_statistics(self.db, [logs[i] for i in result.upserted_ids])
+
+        return events
+
+
+def make_feedback_logs(tag_logs):
+    """Make one log per user, tag and image given {(tag, user): ids}"""
+    return [{'tag': tag, 'user': user, 'image_id': id}
+            for (tag, user), ids in tag_logs.items() for id in ids]
+
+
+def make_log_requests(logs):
+    """Make the upserts of logs, so repeated feedback does not add logs"""
+    return [UpdateOne(log, {'$set': log}, upsert=True) for log in logs]
@@ -1,29 +1,123 @@
 import os
-from os import walk
+import uuid
+import hashlib
 
 
-def save_image(dir_path, image):
-    """Save an image to the given directory path"""
+# Suffix of images being written, they are renamed when complete
+PARTIAL_SUFFIX = '.part'
+
+
+def get_partial_path(path):
+    """Get a temporary path to write an image, unique so concurrent downloads of it do not collide"""
+    return f'{path}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}'
+
+
+def draft_image(im, mode, size):
+    """Let the JPEG decoder scale an opened image down to about size while decoding, return it"""
+    if im.format == 'JPEG':
+        im.draft(mode, size)
+
+    return im
+
+
+def save_image(dir_path, image, storage=None, verbose=True):
+    """
+    Save an image to the given directory path, the content is streamed by the storage if given.
+
+    The image is written to a temporary file and atomically renamed, so an
+    interrupted download never leaves a partial image in the pool.
+
+    Returns:
+    ----------
+    size: Int
+        the number of bytes written
+    """
 
     image_id = str(image['_id'])
     image_type = image['img_type']
-    path = os.path.join(
-        dir_path, f'{image_id}.{image_type}')
-    print(
-        f'Downloading image: {image_id}.{image_type} ...')
-    with open(path, "wb") as f:
-        f.write(image["content"])
+    path = get_image_path(dir_path, f'{image_id}.{image_type}')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if verbose:
+        print(
+            f'Downloading image: {image_id}.{image_type} ...')
 
+    partial_path = get_partial_path(path)
+    try:
+        with open(partial_path, "wb") as f:
+            if storage is None:
+                f.write(image["content"])
+            else:
+                storage.write(image, f)
+            size = f.tell()
 
-def get_downloaded_images_list(dir_path):
-    """Get all filename exclude subfilename under a directory"""
-    _, _, filenames = next(walk(dir_path))
+        os.replace(partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    return size
 
-    images_list = [filename.split('.')[0] for filename in filenames]
+
+def get_downloaded_images_list(dir_path):
+    """Get all filename exclude subfilename in the image pool"""
+    images_list = [entry.name.split('.')[0] for entry in iter_pool_files(dir_path)]
 
     return images_list
 
 
+def get_shard_dir(dir_path, image_id):
+    """
+    Get the directory of an image in the sharded image pool, ex: images/ab/cd/
+
+    The shard is taken from the last bytes of the ObjectId, which hold the
+    counter, since the leading timestamp bytes are shared by most images.
+    """
+    return os.path.join(dir_path, image_id[-2:], image_id[-4:-2])
+
+
 def get_image_path(dir_path, image_name):
     """Get image path given directory path and image filename"""
-    return os.path.join(dir_path, image_name)
+    image_id = image_name.split('.')[0]
+
+    return os.path.join(get_shard_dir(dir_path, image_id), image_name)
+
+
+def is_shard_name(name):
+    """Check whether a directory name is a level of the sharded pool layout"""
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def iter_pool_files(dir_path):
+    """Yield the os.DirEntry of every complete image in the sharded image pool"""
+    for first in os.scandir(dir_path):
+        if not first.is_dir() or not is_shard_name(first.name):
+            continue
+        for second in os.scandir(first.path):
+            if not second.is_dir() or not is_shard_name(second.name):
+                continue
+            for entry in os.scandir(second.path):
+                if entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIX):
+                    yield entry
+
+
+def migrate_pool_layout(dir_path):
+    """Move images of the former flat image pool into the sharded layout, return the number moved"""
+    moved = 0
+
+    for entry in os.scandir(dir_path):
+        if (not entry.is_file() or entry.name.startswith('.') or
+                entry.name.endswith(PARTIAL_SUFFIX)):
+            continue
+
+        path = get_image_path(dir_path, entry.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(entry.path, path)
+        moved += 1
+
+    return moved
+
+
+def get_image_digest(content):
+    """Get the SHA-256 hex digest of the raw image bytes, used for deduplication"""
+    return hashlib.sha256(content).hexdigest()
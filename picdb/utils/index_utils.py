@@ -0,0 +1,100 @@
+from .db_utils import make_tags_filter
+
+
+# Declarative index specs of each collection, every spec holds the keys and
+# the options passed to create_index
+INDEX_SPECS = {
+    "images": [
+        # Only documents that already carry a digest are indexed, so the index
+        # can be built before old documents are backfilled
+        {"keys": [("digest", 1)], "unique": True,
+         "partialFilterExpression": {"digest": {"$exists": True}}},
+        {"keys": [("img_type", 1), ("use_count", 1)]},
+        # Keyset pages of a tag query are read in _id order after the last seen id
+        {"keys": [("img_type", 1), ("_id", 1)]},
+        # Tag names are dynamic keys of the tags document, a wildcard index
+        # covers the credit of every tag
+        {"keys": [("tags.$**", 1)]},
+        # Multi-index hashing of the perceptual hash, one key per segment
+        {"keys": [("phash_segments", 1)]},
+    ],
+    "logs": [
+        # Also serves the feedback upserts of one log per user, tag and image
+        {"keys": [("tag", 1), ("user", 1), ("image_id", 1)]},
+        {"keys": [("user", 1)]},
+    ],
+    "renditions": [
+        {"keys": [("image_id", 1), ("max_edge", 1)], "unique": True},
+    ],
+    "stats": [
+        # Serves the top counts of a kind in the summary sort order, count then name
+        {"keys": [("kind", 1), ("count", -1), ("name", 1)]},
+    ],
+}
+
+
+def ensure_indexes(db, specs=INDEX_SPECS):
+    """Create the indexes given by the specs, existing indexes are left untouched"""
+    created = []
+
+    for collection, indexes in specs.items():
+        for spec in indexes:
+            options = dict(spec)
+            keys = options.pop("keys")
+            created.append(db[collection].create_index(keys, **options))
+
+    return created
+
+
+def get_plan_stages(plan):
+    """Get all stage names of a query plan tree"""
+    stages = [plan.get("stage")]
+
+    for child in [plan.get("inputStage"), plan.get("queryPlan")]:
+        if child:
+            stages += get_plan_stages(child)
+    for child in plan.get("inputStages", []):
+        stages += get_plan_stages(child)
+
+    return [stage for stage in stages if stage]
+
+
+def get_hot_queries(tags, img_type="JPEG", use_count=-1, threshold=100):
+    """Get the frequently issued queries as (name, collection, filter) tuples"""
+    queries = [
+        ("images by tags index", "images",
+         make_tags_filter(tags, img_type, use_count, threshold)),
+        ("images by tags", "images",
+         make_tags_filter(tags, img_type, use_count)),
+        ("images by digest", "images", {"digest": ""}),
+        ("logs by user", "logs", {"user": ""}),
+    ]
+
+    # Logs are only looked up by a given tag
+    if tags:
+        queries.insert(3, ("logs by tag", "logs", {"tag": tags[0]}))
+
+    return queries
+
+
+def check_query_plans(db, tags, img_type="JPEG", use_count=-1, threshold=100):
+    """
+    Explain the hot queries and warn about those falling back to a collection scan.
+
+    Returns:
+    ----------
+    collscans: List[String]
+        the names of queries whose winning plan is a collection scan
+
+    """
+    collscans = []
+
+    for name, collection, query in get_hot_queries(tags, img_type, use_count, threshold):
+        explain = db[collection].find(query).explain()
+        stages = get_plan_stages(explain["queryPlanner"]["winningPlan"])
+
+        if "COLLSCAN" in stages:
+            print(f'Warning: query "{name}" on {collection} is a collection scan: {query}')
+            collscans.append(name)
+
+    return collscans
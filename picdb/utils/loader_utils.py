@@ -0,0 +1,150 @@
+# numpy is only imported when images are loaded as arrays, this module is
+# imported lazily by PicDB.load_images
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .image_utils import get_image_path, draft_image
+
+
+def decode_image(path, height, width):
+    """Decode an image file into an uint8 array of shape (height, width, 3)"""
+    with Image.open(path) as im:
+        im = draft_image(im, 'RGB', (width, height))
+        im = im.convert('RGB').resize((width, height), Image.BILINEAR)
+
+        return np.asarray(im, dtype=np.uint8)
+
+
+def decode_batch(paths, height, width):
+    """Decode image files into an uint8 array of shape (N, height, width, 3)"""
+    batch = np.empty((len(paths), height, width, 3), dtype=np.uint8)
+    for i, path in enumerate(paths):
+        batch[i] = decode_image(path, height, width)
+
+    return batch
+
+
+def normalize_batch(batch, normalize):
+    """
+    Convert an uint8 batch to float32
+
+    Parameters:
+    ----------
+    normalize: Bool or (mean, std)
+        False keeps the uint8 batch, True scales it to [0, 1], a (mean, std)
+        pair of per channel sequences also standardizes the scaled batch
+    """
+    if normalize is False or normalize is None:
+        return batch
+
+    batch = batch.astype(np.float32) / 255
+    if normalize is not True:
+        mean, std = normalize
+        batch = (batch - np.asarray(mean, dtype=np.float32)) / np.asarray(std, dtype=np.float32)
+
+    return batch
+
+
+def get_tensor_cache_path(dir_path, tags_key, version, images_list, height, width):
+    """
+    Get the .npy tensor cache path of a cache version, ex: .picdb/images/tensors/cat-orange/1-224x224-<hash>.npy
+
+    The hash of the images list tells apart the contents of a version that
+    was replaced, like 0-latest after each query.
+    """
+    ids_hash = hashlib.sha1('\n'.join(images_list).encode()).hexdigest()[:12]
+
+    return os.path.join(dir_path, 'tensors', tags_key, f'{version}-{height}x{width}-{ids_hash}.npy')
+
+
+class ImageLoader:
+    """
+    Iterate batches of downloaded images as numpy arrays.
+
+    Batches are decoded in a process pool, and up to prefetch batches are
+    decoded ahead of the one being consumed. With a tensor cache path, the
+    first pass also writes all decoded images into a memory-mapped .npy file,
+    which later passes read instead of decoding anything.
+
+    Each item is (ids, batch), where batch has shape (N, height, width, 3).
+    """
+
+    def __init__(self, dir_path, images_list, img_type, batch_size=32, size=(224, 224),
+                 normalize=False, workers=None, prefetch=2, tensor_cache_path=None):
+        self.dir_path = dir_path
+        self.images_list = list(images_list)
+        self.img_type = img_type
+        self.batch_size = batch_size
+        self.height, self.width = size
+        self.normalize = normalize
+        self.workers = workers
+        self.prefetch = prefetch
+        self.tensor_cache_path = tensor_cache_path
+
+    def __len__(self):
+        return (len(self.images_list) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.tensor_cache_path and os.path.isfile(self.tensor_cache_path):
+            yield from self.iter_tensor_cache()
+        else:
+            yield from self.iter_decoded()
+
+    def get_batches(self):
+        """Split the images list into batches of ids"""
+        return [self.images_list[i:i + self.batch_size]
+                for i in range(0, len(self.images_list), self.batch_size)]
+
+    def iter_tensor_cache(self):
+        """Yield batches sliced from the memory-mapped tensor cache"""
+        tensor = np.load(self.tensor_cache_path, mmap_mode='r')
+
+        for i, ids in enumerate(self.get_batches()):
+            start = i * self.batch_size
+            yield ids, normalize_batch(tensor[start:start + len(ids)], self.normalize)
+
+    def iter_decoded(self):
+        """Decode batches in a process pool and fill the tensor cache if asked"""
+        tensor = None
+        if self.tensor_cache_path:
+            os.makedirs(os.path.dirname(self.tensor_cache_path), exist_ok=True)
+            partial_path = self.tensor_cache_path + '.part'
+            tensor = np.lib.format.open_memmap(
+                partial_path, mode='w+', dtype=np.uint8,
+                shape=(len(self.images_list), self.height, self.width, 3))
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for i, ids in enumerate(self.get_batches()):
+                paths = [get_image_path(self.dir_path, f'{image_id}.{self.img_type}')
+                         for image_id in ids]
+                future = pool.submit(decode_batch, paths, self.height, self.width)
+                pending.append((i * self.batch_size, ids, future))
+
+                # Keep prefetch batches decoding while the current one is consumed
+                if len(pending) > self.prefetch:
+                    yield self.consume(pending.popleft(), tensor)
+
+            while pending:
+                yield self.consume(pending.popleft(), tensor)
+
+        if tensor is not None:
+            tensor.flush()
+            del tensor
+            # Only complete tensors are read by later passes
+            os.replace(partial_path, self.tensor_cache_path)
+
+    def consume(self, item, tensor):
+        """Wait for a decoded batch and copy it into the tensor cache"""
+        start, ids, future = item
+        batch = future.result()
+
+        if tensor is not None:
+            tensor[start:start + len(ids)] = batch
+
+        return ids, normalize_batch(batch, self.normalize)
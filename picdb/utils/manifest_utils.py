@@ -0,0 +1,196 @@
+import os
+from time import time
+
+from .catalog_utils import get_catalog, catalog_lock
+from .image_utils import iter_pool_files, get_image_path
+
+
+class ImageManifest:
+    """
+    Persistent manifest of the images downloaded into an image pool.
+
+    The ids are kept in memory as a set, so checking which images are already
+    downloaded needs no directory walk. Each image also records its type,
+    size, digest, modification time and accesses in the local catalog, which
+    decide the images to evict when the pool exceeds its disk budget.
+    """
+
+    def __init__(self, dir_path, pool='original', catalog_dir=None):
+        self.dir_path = dir_path
+        self.pool = pool
+        # Derived pools, like renditions, share the catalog of the main pool
+        self.conn = get_catalog(catalog_dir or dir_path)
+
+        result = self.conn.execute(
+            'SELECT image_id FROM pool_images WHERE pool = ?', (pool,))
+        self.images = {image_id for image_id, in result}
+        self.total_size, = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pool_images WHERE pool = ?', (pool,)).fetchone()
+
+        # Pools downloaded before the manifest existed are read from disk once
+        if not self.images:
+            self.reconcile()
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        return iter(list(self.images))
+
+    def add_many(self, records):
+        """Record downloaded images given (image_id, img_type, size, digest) tuples"""
+        now = time()
+        records = [(self.pool, str(image_id), img_type, size, digest, now, now)
+                   for image_id, img_type, size, digest in records]
+        if not records:
+            return
+
+        with catalog_lock, self.conn:
+            # Images downloaded again replace their former size
+            replaced = [record[1] for record in records if record[1] in self.images]
+            self.total_size -= self.get_size(replaced)
+
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pool_images '
+                '(pool, image_id, img_type, size, digest, mtime, last_access, access_count) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, 1)',
+                records)
+            self.images.update(record[1] for record in records)
+            self.total_size += sum(record[3] for record in records)
+
+    def add(self, image_id, img_type, size, digest=None):
+        """Record one downloaded image"""
+        self.add_many([(image_id, img_type, size, digest)])
+
+    def get_size(self, ids):
+        """Get the total size of the given downloaded images"""
+        size = 0
+        for image_id in ids:
+            row = self.conn.execute(
+                'SELECT size FROM pool_images WHERE pool = ? AND image_id = ?',
+                (self.pool, str(image_id))).fetchone()
+            size += row[0] if row else 0
+
+        return size
+
+    def touch(self, ids):
+        """Record an access to the given images"""
+        with catalog_lock, self.conn:
+            self.conn.executemany(
+                'UPDATE pool_images SET last_access = ?, access_count = access_count + 1 '
+                'WHERE pool = ? AND image_id = ?',
+                ((time(), self.pool, str(image_id)) for image_id in ids))
+
+    def pin(self, ids, pinned=True):
+        """Keep the given images from eviction, or allow it again with pinned=False"""
+        with catalog_lock, self.conn:
+            self.conn.executemany(
+                'UPDATE pool_images SET pinned = ? WHERE pool = ? AND image_id = ?',
+                ((int(pinned), self.pool, str(image_id)) for image_id in ids))
+
+    def remove_many(self, ids):
+        """Forget images removed from the pool"""
+        ids = [str(image_id) for image_id in ids if str(image_id) in self.images]
+
+        with catalog_lock, self.conn:
+            self.total_size -= self.get_size(ids)
+            self.conn.executemany(
+                'DELETE FROM pool_images WHERE pool = ? AND image_id = ?',
+                ((self.pool, image_id) for image_id in ids))
+            self.images.difference_update(ids)
+
+    def get_info(self, image_id):
+        """Get (img_type, size, digest, mtime) of a downloaded image, None if not downloaded"""
+        return self.conn.execute(
+            'SELECT img_type, size, digest, mtime FROM pool_images WHERE pool = ? AND image_id = ?',
+            (self.pool, str(image_id))).fetchone()
+
+    def reconcile(self):
+        """
+        Rebuild the manifest from the images on disk.
+
+        Returns:
+        ----------
+        (added, removed):
+            the number of images found on disk but not in the manifest, and
+            the number of images in the manifest but not on disk
+
+        """
+        on_disk = {}
+        if os.path.isdir(self.dir_path):
+            for entry in iter_pool_files(self.dir_path):
+                image_id, _, img_type = entry.name.partition('.')
+                stat = entry.stat()
+                on_disk[image_id] = (img_type, stat.st_size, stat.st_mtime)
+
+        digests = dict(self.conn.execute(
+            'SELECT image_id, digest FROM pool_images WHERE pool = ?', (self.pool,)).fetchall())
+        pinned = {image_id for image_id, in self.conn.execute(
+            'SELECT image_id FROM pool_images WHERE pool = ? AND pinned', (self.pool,))}
+
+        added = len(on_disk.keys() - digests.keys())
+        removed = len(digests.keys() - on_disk.keys())
+
+        with catalog_lock, self.conn:
+            self.conn.execute('DELETE FROM pool_images WHERE pool = ?', (self.pool,))
+            self.conn.executemany(
+                'INSERT INTO pool_images (pool, image_id, img_type, size, digest, mtime, pinned) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((self.pool, image_id, img_type, size, digests.get(image_id), mtime,
+                  int(image_id in pinned))
+                 for image_id, (img_type, size, mtime) in on_disk.items()))
+            self.images = set(on_disk)
+            self.total_size = sum(size for _, size, _ in on_disk.values())
+
+        return added, removed
+
+    def evict(self, budget, policy='lru', batch_size=100):
+        """
+        Delete images until the pool fits in the disk budget.
+
+        Images are evicted in least recently used ('lru') or least frequently
+        used ('lfu') order from the manifest, images listed by a named cache
+        version (any version but 0-latest) and pinned images are never evicted.
+
+        Returns:
+        ----------
+        (count, size):
+            the number of evicted images and their total bytes
+
+        """
+        if self.total_size <= budget:
+            return 0, 0
+
+        order = {'lru': 'last_access', 'lfu': 'access_count, last_access'}[policy]
+        query = ('SELECT image_id, img_type, size FROM pool_images AS p WHERE pool = ? AND NOT pinned '
+                 'AND NOT EXISTS (SELECT 1 FROM cache_images AS c '
+                 'WHERE c.image_id = p.image_id AND c.version > 0) '
+                 f'ORDER BY {order} LIMIT ?')
+
+        count, size = 0, 0
+        while self.total_size > budget:
+            # Evicted images leave the manifest, so each query gets the next batch
+            batch = self.conn.execute(query, (self.pool, batch_size)).fetchall()
+            if not batch:
+                break
+
+            evicted, remaining = [], self.total_size
+            for image_id, img_type, image_size in batch:
+                if remaining <= budget:
+                    break
+                try:
+                    os.remove(get_image_path(self.dir_path, f'{image_id}.{img_type}'))
+                except FileNotFoundError:
+                    pass
+                evicted.append(image_id)
+                remaining -= image_size
+
+            before = self.total_size
+            self.remove_many(evicted)
+            count += len(evicted)
+            size += before - self.total_size
+
+        return count, size
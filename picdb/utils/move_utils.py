@@ -0,0 +1,111 @@
+import os
+import errno
+import shutil
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .image_utils import get_image_path
+
+
+MOVE_MODES = ['auto', 'link', 'symlink', 'copy']
+
+
+def copy_file(src_path, dst_path):
+    """
+    Copy a file inside the kernel, return the copied size.
+
+    os.copy_file_range is tried first, which can share extents (reflinks) on
+    filesystems supporting it, then os.sendfile, and a buffered copy last.
+    """
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+
+        for copy in [getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)]:
+            if copy is None:
+                continue
+            try:
+                copied = 0
+                while copied < size:
+                    if copy is os.sendfile:
+                        sent = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+                    else:
+                        sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied,
+                                                  copied, copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+
+                if copied == size:
+                    return size
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+            # Start over with the next method
+            dst.seek(0)
+            dst.truncate()
+
+        src.seek(0)
+        shutil.copyfileobj(src, dst)
+
+    return size
+
+
+def place_image(src_path, dst_path, mode='auto'):
+    """
+    Place an image of the pool at the destination, return its size.
+
+    mode:
+        'link': hard link, 'symlink': symbolic link, 'copy': copy the content,
+        'auto': hard link, or copy when the destination is on another filesystem
+    """
+    if mode == 'copy':
+        return copy_file(src_path, dst_path)
+
+    size = os.path.getsize(src_path)
+
+    if mode == 'symlink':
+        os.symlink(src_path, dst_path)
+        return size
+
+    try:
+        os.link(src_path, dst_path)
+    except OSError as e:
+        if mode == 'link' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        return copy_file(src_path, dst_path)
+
+    return size
+
+
+def move_images_to(dir_path, images_list, img_type, dst_path, mode='auto', workers=8):
+    """
+    Place images of the pool into the destination directory on a thread pool.
+
+    Returns:
+    ----------
+    (count, size, seconds, missing):
+        the number of placed images, their total bytes, the elapsed time and
+        the ids of images not found in the pool
+
+    """
+    if mode not in MOVE_MODES:
+        raise ValueError(f'mode must be one of {MOVE_MODES}')
+
+    def move_image(image_name):
+        img_path = f'{image_name}.{img_type}'
+        src_image_path = get_image_path(dir_path, img_path)
+        dst_image_path = os.path.join(dst_path, img_path)
+        try:
+            return place_image(src_image_path, dst_image_path, mode)
+        except FileNotFoundError:
+            return None
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        sizes = list(pool.map(move_image, images_list))
+    seconds = perf_counter() - start
+
+    missing = [image_name for image_name, size in zip(images_list, sizes) if size is None]
+    size = sum(size for size in sizes if size is not None)
+
+    return len(images_list) - len(missing), size, seconds, missing
@@ -0,0 +1,108 @@
+import json
+import base64
+import hashlib
+
+from bson.objectid import ObjectId
+
+from .db_utils import make_tags_filter
+
+
+def get_query_hash(tags, img_type, use_count, min_credit=None):
+    """Get the hash of a tag query, which does not depend on the tags order"""
+    query = json.dumps([sorted(set(tags)), img_type, use_count, min_credit])
+
+    return hashlib.sha1(query.encode()).hexdigest()[:16]
+
+
+def make_continuation_token(query_hash, after):
+    """Make a token resuming a query after the given image id"""
+    token = json.dumps({"query": query_hash, "after": str(after)})
+
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def parse_continuation_token(token, query_hash):
+    """
+    Get the image id a token resumes after
+
+    Raises:
+    ----------
+    ValueError:
+        the token is malformed or was made by another query
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(token.encode()))
+        after = ObjectId(token["after"])
+    except Exception as e:
+        raise ValueError(f'Invalid continuation token: {e}')
+
+    if token["query"] != query_hash:
+        raise ValueError('The continuation token was made by another query')
+
+    return after
+
+
+class TagQueryIterator:
+    """
+    Stream the ids of images matching a tag query in _id order, page by page.
+
+    Every page is one query on _id greater than the last seen id, so memory
+    is bounded by page_size and no page re-reads the former ones. token
+    resumes the iteration, also from another process or after a crash.
+    Iterating ids advances it past an id when the next id is asked for, so
+    the id being handled is yielded again on resume. pages() advances it
+    past a page as soon as the page is yielded, so save the token only once
+    the whole page is handled.
+    """
+
+    def __init__(self, db, tags, img_type="JPEG", use_count=-1, page_size=1000, token=None,
+                 min_credit=None):
+        self.db = db
+        self.query = make_tags_filter(tags, img_type, use_count, min_credit)
+        self.query_hash = get_query_hash(tags, img_type, use_count, min_credit)
+        self.page_size = page_size
+
+        self.after = None if token is None else parse_continuation_token(token, self.query_hash)
+        self.token = token
+        self.done = False
+
+    def __iter__(self):
+        while not self.done:
+            for image_id in self.fetch_page():
+                yield image_id
+                # The consumer asks for the next id once it handled this one
+                self.token = make_continuation_token(self.query_hash, image_id)
+
+    def pages(self):
+        """Yield lists of at most page_size image ids"""
+        while not self.done:
+            page = self.next_page()
+            if page:
+                yield page
+
+    def next_page(self):
+        """Fetch the next page of image ids and advance token past it, an empty list when exhausted"""
+        page = self.fetch_page()
+        if page:
+            self.token = make_continuation_token(self.query_hash, self.after)
+
+        return page
+
+    def fetch_page(self):
+        """Fetch the next page of image ids without advancing token"""
+        if self.done:
+            return []
+
+        query = dict(self.query)
+        if self.after is not None:
+            query["_id"] = {"$gt": self.after}
+
+        result = self.db.images.find(query, {"_id": 1}).sort("_id", 1).limit(self.page_size)
+        id_list = [image["_id"] for image in result]
+
+        if len(id_list) < self.page_size:
+            self.done = True
+        if id_list:
+            self.after = id_list[-1]
+
+        return [str(id) for id in id_list]
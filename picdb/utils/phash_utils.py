@@ -0,0 +1,314 @@
+import io
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from pymongo import UpdateOne
+
+from .image_utils import draft_image
+
+
+# A 64 bits dHash is split into 4 segments of 16 bits for multi-index hashing
+PHASH_SIZE = 8
+PHASH_SEGMENTS = 4
+SEGMENT_BITS = 16
+SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+
+def compute_dhash(content, hash_size=PHASH_SIZE):
+    """
+    Compute the difference hash of image content as an integer of hash_size**2 bits.
+
+    Each bit tells whether a pixel is brighter than its right neighbour in
+    a grayscale thumbnail, so resized or recompressed copies of an image
+    get hashes within a small Hamming distance. None if it cannot be decoded.
+    """
+    try:
+        im = draft_image(Image.open(io.BytesIO(content)), 'L', (hash_size + 1, hash_size))
+        im = im.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    except (OSError, ValueError):
+        return None
+
+    pixels = list(im.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+
+    return value
+
+
+def format_phash(value):
+    """Format a hash as the hex string stored in image documents"""
+    return f'{value:016x}'
+
+
+def parse_phash(phash):
+    return int(phash, 16)
+
+
+def get_phash_segments(value):
+    """Get the segment keys of a hash, ex: ['0:1f2e', '1:...', ...], indexed by phash_segments"""
+    return [f'{i}:{(value >> (i * SEGMENT_BITS)) & SEGMENT_MASK:04x}'
+            for i in range(PHASH_SEGMENTS)]
+
+
+def get_segment_variants(value, radius):
+    """
+    Get the segment keys of every hash sharing a segment with value within radius.
+
+    Two hashes within radius differ in at most radius // PHASH_SEGMENTS bits
+    in one of their segments, so matching these keys finds them all.
+    """
+    tolerance = radius // PHASH_SEGMENTS
+    variants = []
+
+    for i in range(PHASH_SEGMENTS):
+        segment = (value >> (i * SEGMENT_BITS)) & SEGMENT_MASK
+        for flips in range(tolerance + 1):
+            for bits in combinations(range(SEGMENT_BITS), flips):
+                variant = segment
+                for bit in bits:
+                    variant ^= 1 << bit
+                variants.append(f'{i}:{variant:04x}')
+
+    return variants
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def make_near_duplicates_query(value, radius):
+    """Query the candidates sharing a segment with value within radius, with the phash_segments index"""
+    return {"phash_segments": {"$in": get_segment_variants(value, radius)}}
+
+
+def rank_near_duplicates(value, radius, candidates):
+    """Keep the candidate images within radius of value, as (id, distance) nearest first"""
+    near_duplicates = []
+    for image in candidates:
+        distance = hamming_distance(value, parse_phash(image["phash"]))
+        if distance <= radius:
+            near_duplicates.append((image["_id"], distance))
+
+    return sorted(near_duplicates, key=lambda item: item[1])
+
+
+def find_near_duplicate_images(db, value, radius):
+    """
+    Find images whose hash is within radius of value, with the phash_segments index.
+
+    Returns:
+    ----------
+    near_duplicates: List[(ObjectId, Int)]
+        the image ids and their distances, nearest first
+
+    """
+    candidates = db.images.find(make_near_duplicates_query(value, radius), {"phash": 1})
+
+    return rank_near_duplicates(value, radius, candidates)
+
+
+def drop_near_duplicates(db, records, radius):
+    """
+    Drop the records within radius of an image in the database or of a former record.
+
+    The candidates of the whole batch are fetched with one query.
+
+    Returns:
+    ----------
+    (kept, dropped): (List[dict], Int)
+    """
+    hashed = [record for record in records if record.get("phash") is not None]
+    variants = set()
+    for record in hashed:
+        variants.update(get_segment_variants(record["phash"], radius))
+
+    tree = BKTree()
+    if variants:
+        for image in db.images.find({"phash_segments": {"$in": list(variants)}}, {"phash": 1}):
+            tree.add(parse_phash(image["phash"]), image["_id"])
+
+    kept = []
+    for record in records:
+        value = record.get("phash")
+        if value is not None:
+            if tree.query(value, radius):
+                continue
+            tree.add(value, record["digest"])
+        kept.append(record)
+
+    return kept, len(records) - len(kept)
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance.
+
+    A query only descends into children whose edge distance is within
+    radius of the distance to the node, which skips most of the tree for
+    small radii.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        """Add an item with its hash"""
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            node_value, items, children = node
+            distance = hamming_distance(value, node_value)
+            if distance == 0:
+                items.append(item)
+                return
+            if distance not in children:
+                children[distance] = (value, [item], {})
+                return
+            node = children[distance]
+
+    def query(self, value, radius):
+        """Get the (item, distance) of every hash within radius of value"""
+        if self.root is None:
+            return []
+
+        result = []
+        nodes = [self.root]
+        while nodes:
+            node_value, items, children = nodes.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= radius:
+                result += [(item, distance) for item in items]
+
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    nodes.append(child)
+
+        return result
+
+
+# The tree of all hashes in each worker process of find_near_duplicate_pairs
+worker_tree = None
+
+
+def init_worker_tree(values):
+    global worker_tree
+    worker_tree = BKTree()
+    for i, value in enumerate(values):
+        worker_tree.add(value, i)
+
+
+def query_worker_tree(chunk, radius):
+    """Get the (i, j) pairs with i < j within radius for the (i, value) of a chunk"""
+    pairs = []
+    for i, value in chunk:
+        pairs += [(i, j) for j, _ in worker_tree.query(value, radius) if j > i]
+
+    return pairs
+
+
+def find_near_duplicate_pairs(values, radius, workers=None, chunk_size=1000):
+    """Get the index pairs of hashes within radius, querying a BK-tree in a process pool"""
+    indexed = list(enumerate(values))
+    chunks = [indexed[i:i + chunk_size] for i in range(0, len(indexed), chunk_size)]
+
+    pairs = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_tree,
+                             initargs=(values,)) as pool:
+        for chunk_pairs in pool.map(query_worker_tree, chunks, [radius] * len(chunks)):
+            pairs += chunk_pairs
+
+    return pairs
+
+
+def cluster_pairs(count, pairs):
+    """Group the indexes connected by pairs with union-find, return the groups of more than one"""
+    parents = list(range(count))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_near_duplicates(db, radius=4, workers=None, chunk_size=1000):
+    """
+    Cluster the images of the database whose hashes are within radius.
+
+    Returns:
+    ----------
+    clusters: List[List[String]]
+        the image ids of each cluster of near duplicates, oldest first
+
+    """
+    images = list(db.images.find({"phash": {"$exists": True}}, {"phash": 1}).sort("_id", 1))
+    values = [parse_phash(image["phash"]) for image in images]
+
+    pairs = find_near_duplicate_pairs(values, radius, workers, chunk_size)
+
+    return [[str(images[i]["_id"]) for i in group]
+            for group in cluster_pairs(len(images), pairs)]
+
+
+def backfill_images_phash(db, storage, batch_size=500, workers=None):
+    """
+    Compute and store the perceptual hash of images uploaded without one.
+
+    Returns:
+    ----------
+    updated: Int
+        the number of updated images
+    """
+    updated = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Updated images leave the filter, so the next batch starts over
+            images = list(db.images.find(
+                {"phash": {"$exists": False}, "phash_failed": {"$exists": False}},
+                {"content": 1, "blob_id": 1}).limit(batch_size))
+            if not images:
+                break
+
+            contents = [storage.read(image) for image in images]
+            requests = []
+            for image, value in zip(images, pool.map(compute_dhash, contents)):
+                if value is None:
+                    # Never retried, the content cannot be decoded
+                    requests.append(UpdateOne({"_id": image["_id"]}, {"$set": {"phash_failed": True}}))
+                    continue
+                requests.append(UpdateOne({"_id": image["_id"]}, {"$set": make_phash_fields(value)}))
+                updated += 1
+
+            db.images.bulk_write(requests, ordered=False)
+
+    return updated
+
+
+def make_phash_fields(value):
+    """Make the phash fields of an image document"""
+    return {"phash": format_phash(value), "phash_segments": get_phash_segments(value)}
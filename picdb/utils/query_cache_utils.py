@@ -0,0 +1,146 @@
+import json
+import threading
+from time import time
+from collections import OrderedDict
+
+from .catalog_utils import catalog_lock
+
+
+def make_query_key(tags, img_type, use_count, limit, threshold, order=None):
+    """Make the key of a query, which does not depend on the tags order or repeated tags"""
+    return json.dumps([sorted(set(tags)), img_type, use_count, limit, threshold, order])
+
+
+def make_rank_order(tags, weights=None):
+    """Make the order of a ranked query, the weight of each tag, which tells it apart in the cache"""
+    return sorted((tag, (weights or {}).get(tag, 1)) for tag in tags)
+
+
+def make_tags_column(tags):
+    """Make the tags column of a shared result, ex: ,cat,orange, so a tag is found by instr"""
+    return ',' + ','.join(sorted(set(tags))) + ','
+
+
+class QueryResultCache:
+    """
+    LRU cache of image id queries with a time to live.
+
+    Results are kept in memory, at most maxsize of them, and expire ttl
+    seconds after the query. With a catalog connection they are also kept
+    in the query_results table, so processes sharing the image store share
+    the results. Results of a tag are invalidated when credits or images of
+    that tag change, other processes drop their in-memory results after ttl.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, conn=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.conn = conn
+
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tags, img_type, use_count, limit, threshold, order=None):
+        """Get the cached images list of a query, None if not cached or expired"""
+        key = make_query_key(tags, img_type, use_count, limit, threshold, order)
+        now = time()
+
+        with self.lock:
+            if key in self.results:
+                expires, images_list = self.results[key]
+                if expires > now:
+                    self.results.move_to_end(key)
+                    self.hits += 1
+                    return list(images_list)
+                del self.results[key]
+
+        images_list = self.get_shared(key, now)
+
+        with self.lock:
+            if images_list is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return images_list
+
+    def get_shared(self, key, now):
+        """Get a result from the catalog, and keep it in memory until it expires there"""
+        if self.conn is None:
+            return None
+
+        row = self.conn.execute(
+            'SELECT images, expires FROM query_results WHERE key = ? AND expires > ?',
+            (key, now)).fetchone()
+        if row is None:
+            return None
+
+        images_list = json.loads(row[0])
+        self.put_local(key, images_list, row[1])
+
+        return list(images_list)
+
+    def put(self, tags, img_type, use_count, limit, threshold, images_list, order=None):
+        """
+        Cache the images list of a query
+
+        order tells apart ranked queries, for example the weights of their tags.
+        """
+        key = make_query_key(tags, img_type, use_count, limit, threshold, order)
+        expires = time() + self.ttl
+
+        self.put_local(key, list(images_list), expires)
+
+        if self.conn is not None:
+            with catalog_lock, self.conn:
+                self.conn.execute('DELETE FROM query_results WHERE expires <= ?', (time(),))
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO query_results (key, tags, images, expires) '
+                    'VALUES (?, ?, ?, ?)',
+                    (key, make_tags_column(tags), json.dumps(images_list), expires))
+
+    def put_local(self, key, images_list, expires):
+        with self.lock:
+            self.results[key] = (expires, images_list)
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def invalidate_tags(self, tags):
+        """Drop the results of every query involving one of the tags"""
+        tags = set(tags)
+        if not tags:
+            return
+
+        with self.lock:
+            for key in list(self.results):
+                if tags.intersection(json.loads(key)[0]):
+                    del self.results[key]
+
+        if self.conn is not None:
+            with catalog_lock, self.conn:
+                self.conn.executemany(
+                    'DELETE FROM query_results WHERE instr(tags, ?) > 0',
+                    ((f',{tag},',) for tag in tags))
+
+    def clear(self):
+        """Drop all results, the counters are kept"""
+        with self.lock:
+            self.results.clear()
+
+        if self.conn is not None:
+            with catalog_lock, self.conn:
+                self.conn.execute('DELETE FROM query_results')
+
+    def get_stats(self):
+        """Get the hits, misses, hit rate and size of the cache"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self.results)
+            }
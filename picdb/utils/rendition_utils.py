@@ -0,0 +1,138 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from bson.objectid import ObjectId
+from PIL import Image
+from pymongo.errors import BulkWriteError
+
+from .db_utils import iter_images_content_from_database
+from .image_utils import draft_image
+
+
+# The projection to fetch rendition content regardless of where it is stored
+RENDITION_PROJECTION = {"image_id": 1, "content": 1, "blob_id": 1, "img_type": 1}
+
+
+def make_rendition(content, max_edge):
+    """
+    Resize image content so its longer edge is at most max_edge.
+
+    Returns:
+    ----------
+    (content, img_type, width, height):
+        the encoded rendition, None if the image cannot be decoded
+
+    """
+    try:
+        im = draft_image(Image.open(io.BytesIO(content)), 'RGB', (max_edge, max_edge))
+        img_type = im.format
+
+        im.thumbnail((max_edge, max_edge))
+
+        image_bytes = io.BytesIO()
+        im.save(image_bytes, format=img_type)
+    except (OSError, ValueError):
+        return None
+
+    width, height = im.size
+
+    return image_bytes.getvalue(), img_type, width, height
+
+
+def get_rendition_dir(dir_path, max_edge):
+    """Get the image pool directory of a rendition size, ex: .picdb/images/renditions/256"""
+    return os.path.join(dir_path, 'renditions', str(max_edge))
+
+
+def get_missing_renditions(db, images_list, max_edge):
+    """Get the ids of images without a rendition of the given size"""
+    id_list = [ObjectId(id) for id in images_list]
+    existed = db.renditions.find(
+        {"image_id": {"$in": id_list}, "max_edge": max_edge}, {"image_id": 1})
+    existed = {str(rendition["image_id"]) for rendition in existed}
+
+    return [id for id in images_list if str(id) not in existed]
+
+
+# Fewer missing renditions are resized in this process, a process pool costs more to start
+MIN_POOL_RENDITIONS = 8
+
+
+def ensure_renditions(db, storage, images_list, max_edge, workers=None, batch_size=100):
+    """
+    Generate and store the renditions of given images that do not exist yet.
+
+    Originals are downloaded batch by batch, resized on this client and the
+    renditions uploaded, so only one batch of originals is held in memory.
+    Batches are resized in a process pool unless fewer than
+    MIN_POOL_RENDITIONS renditions are missing.
+
+    Returns:
+    ----------
+    count: Int
+        the number of generated renditions
+
+    """
+    missing = get_missing_renditions(db, images_list, max_edge)
+    if not missing:
+        return 0
+
+    if len(missing) < MIN_POOL_RENDITIONS:
+        return store_renditions(db, storage, missing, max_edge, map, batch_size)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return store_renditions(db, storage, missing, max_edge, pool.map, batch_size)
+
+
+def store_renditions(db, storage, images_list, max_edge, map_func, batch_size=100):
+    """Resize the given images batch by batch with map_func and insert their renditions, return the count"""
+    count = 0
+    for i in range(0, len(images_list), batch_size):
+        images = list(iter_images_content_from_database(
+            db, images_list[i:i + batch_size], batch_size))
+        contents = [storage.read(image) for image in images]
+        results = map_func(make_rendition, contents, [max_edge] * len(contents))
+
+        renditions = []
+        for image, result in zip(images, results):
+            if result is None:
+                continue
+            content, img_type, width, height = result
+            rendition = {
+                "image_id": image["_id"],
+                "max_edge": max_edge,
+                "img_type": img_type,
+                "width": width,
+                "height": height
+            }
+            renditions.append(storage.put(rendition, content))
+
+        if not renditions:
+            continue
+
+        try:
+            db.renditions.insert_many(renditions, ordered=False)
+            count += len(renditions)
+        except BulkWriteError as e:
+            # Generated concurrently by another client
+            failed = {error["index"] for error in e.details["writeErrors"]}
+            for index in failed:
+                storage.delete(renditions[index])
+            count += len(renditions) - len(failed)
+
+    return count
+
+
+def iter_renditions_from_database(db, images_list, max_edge, batch_size=100):
+    """Yield the renditions of given images like image documents, batch by batch"""
+    for i in range(0, len(images_list), batch_size):
+        id_list = [ObjectId(id) for id in images_list[i:i + batch_size]]
+        renditions = db.renditions.find(
+            {"image_id": {"$in": id_list}, "max_edge": max_edge},
+            RENDITION_PROJECTION).batch_size(batch_size)
+
+        for rendition in renditions:
+            # Saved and recorded under the id of the original image
+            rendition["_id"] = rendition.pop("image_id")
+            yield rendition
@@ -0,0 +1,189 @@
+import os
+import json
+import mmap
+
+from .image_utils import get_image_path, PARTIAL_SUFFIX
+
+
+# Name of the offset index of a packed cache version
+SHARD_INDEX_NAME = 'index.json'
+SHARD_FORMAT_VERSION = 1
+
+
+def get_shard_name(generation, number):
+    """Get the file name of a shard of an export generation, ex: shard-0001-00000.bin"""
+    return f'shard-{generation:04d}-{number:05d}.bin'
+
+
+def read_shard_index(dst_path):
+    """Get the index of a packed cache version, None if it was never exported"""
+    try:
+        with open(os.path.join(dst_path, SHARD_INDEX_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_packed_dir(dir_path, tags_key, version):
+    """Get the default directory of a packed cache version, ex: .picdb/images/packed/cat-orange/1"""
+    return os.path.join(dir_path, 'packed', tags_key, str(version))
+
+
+def pack_images(dir_path, images_list, img_type, dst_path, cache_info, manifest=None,
+                shard_size=2**30):
+    """
+    Pack downloaded images into append-only shard files with an offset index.
+
+    Images are appended in the order of images_list and a new shard is
+    started when the current one would exceed shard_size. The index records
+    the shard, offset and size of each image, and is written last, so an
+    interrupted export is never read.
+
+    Exporting again into dst_path writes the shards of a new generation
+    next to the former ones, which stay intact until the new index replaces
+    the former index, and are removed then.
+
+    Returns:
+    ----------
+    (count, size, missing):
+        the number of packed images, their total bytes and the ids of images
+        not found in the pool
+
+    """
+    os.makedirs(dst_path, exist_ok=True)
+
+    former_index = read_shard_index(dst_path)
+    former_shards = former_index["shards"] if former_index is not None else []
+    generation = former_index.get("generation", 0) + 1 if former_index is not None else 0
+
+    entries = []
+    missing = []
+    shards = []
+    shard = None
+    shard_offset = 0
+    size = 0
+
+    try:
+        for image_id in images_list:
+            src_path = get_image_path(dir_path, f'{image_id}.{img_type}')
+            try:
+                src = open(src_path, "rb")
+            except FileNotFoundError:
+                missing.append(image_id)
+                continue
+
+            with src:
+                image_size = os.fstat(src.fileno()).st_size
+
+                if shard is None or (shard_offset and shard_offset + image_size > shard_size):
+                    if shard is not None:
+                        shard.close()
+                    shards.append(get_shard_name(generation, len(shards)))
+                    shard = open(os.path.join(dst_path, shards[-1]), "wb")
+                    shard_offset = 0
+
+                content = src.read()
+                shard.write(content)
+
+            info = manifest.get_info(image_id) if manifest is not None else None
+            digest = info[2] if info is not None else None
+
+            entries.append([image_id, len(shards) - 1, shard_offset, image_size, img_type, digest])
+            shard_offset += image_size
+            size += image_size
+    finally:
+        if shard is not None:
+            shard.close()
+
+    index = {
+        "format": SHARD_FORMAT_VERSION,
+        "generation": generation,
+        "tags": cache_info["tags"],
+        "img_type": img_type,
+        "use_count": cache_info["use_count"],
+        "limit": cache_info["limit"],
+        "shards": shards,
+        "images": entries
+    }
+
+    index_path = os.path.join(dst_path, SHARD_INDEX_NAME)
+    with open(index_path + PARTIAL_SUFFIX, "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + PARTIAL_SUFFIX, index_path)
+
+    # Open readers keep their mapping of removed shards
+    for shard_name in set(former_shards) - set(shards):
+        try:
+            os.remove(os.path.join(dst_path, shard_name))
+        except FileNotFoundError:
+            pass
+
+    return len(entries), size, missing
+
+
+class ShardReader:
+    """
+    Random and sequential access to a packed cache version by mmap.
+
+    Reading an image returns a memoryview into the mapped shard, so no bytes
+    are copied until the caller needs them. Views must be released before
+    the reader is closed.
+    """
+
+    def __init__(self, src_path):
+        with open(os.path.join(src_path, SHARD_INDEX_NAME)) as f:
+            self.index = json.load(f)
+
+        if self.index["format"] != SHARD_FORMAT_VERSION:
+            raise ValueError(f'Unsupported packed format {self.index["format"]}')
+
+        self.src_path = src_path
+        self.ids = [entry[0] for entry in self.index["images"]]
+        self.entries = {entry[0]: entry for entry in self.index["images"]}
+
+        self.maps = []
+        for shard_name in self.index["shards"]:
+            with open(os.path.join(src_path, shard_name), "rb") as f:
+                # mmap cannot map empty files
+                if os.fstat(f.fileno()).st_size == 0:
+                    self.maps.append(b'')
+                    continue
+                shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(shard_map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                shard_map.madvise(mmap.MADV_SEQUENTIAL)
+            self.maps.append(shard_map)
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.entries
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, image_id):
+        """Get a zero-copy view of the encoded bytes of an image"""
+        _, shard, offset, size, _, _ = self.entries[str(image_id)]
+
+        return memoryview(self.maps[shard])[offset:offset + size]
+
+    def __iter__(self):
+        """Yield (image_id, view) in shard order, which reads the shards sequentially"""
+        for image_id in self.ids:
+            yield image_id, self[image_id]
+
+    def get_info(self, image_id):
+        """Get (img_type, size, digest) of a packed image"""
+        _, _, _, size, img_type, digest = self.entries[str(image_id)]
+
+        return img_type, size, digest
+
+    def close(self):
+        for shard_map in self.maps:
+            if isinstance(shard_map, mmap.mmap):
+                shard_map.close()
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,82 @@
+from collections import Counter
+
+from pymongo import UpdateOne
+
+
+def get_summary_statistics(db, top_num=3):
+    """
+    Get the summary of the database with one aggregation over the logs.
+
+    Returns:
+    ----------
+    summary: dict
+        total_images, total_logs, and the top tags and users as (name, count) lists
+
+    """
+    def top(field):
+        return [{'$group': {'_id': '$' + field, 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': top_num}]
+
+    result = list(db.logs.aggregate([
+        {'$facet': {
+            'total': [{'$count': 'count'}],
+            'tags': top('tag'),
+            'users': top('user')
+        }}
+    ]))[0]
+
+    return {
+        # The collection metadata holds the count, no scan is needed
+        'total_images': db.images.estimated_document_count(),
+        'total_logs': result['total'][0]['count'] if result['total'] else 0,
+        'tags': [(item['_id'], item['count']) for item in result['tags']],
+        'users': [(item['_id'], item['count']) for item in result['users']]
+    }
+
+
+def increment_statistics(db, logs):
+    """Count newly inserted logs into the materialized statistics collection"""
+    requests = make_statistics_requests(logs)
+    if requests:
+        db.stats.bulk_write(requests, ordered=False)
+
+
+def make_statistics_requests(logs):
+    """Make the upserts counting logs into the materialized statistics collection"""
+    counts = Counter()
+    for log in logs:
+        counts[('tag', log['tag'])] += 1
+        counts[('user', log['user'])] += 1
+
+    return [UpdateOne({'_id': f'{kind}:{name}'},
+                      {'$set': {'kind': kind, 'name': name}, '$inc': {'count': count}},
+                      upsert=True)
+            for (kind, name), count in counts.items()]
+
+
+def get_materialized_statistics(db, top_num=3):
+    """Get the summary of the database from the materialized statistics collection"""
+    def top(kind):
+        result = db.stats.find({'kind': kind}).sort([('count', -1), ('name', 1)]).limit(top_num)
+        return [(item['name'], item['count']) for item in result]
+
+    return {
+        'total_images': db.images.estimated_document_count(),
+        'total_logs': db.logs.estimated_document_count(),
+        'tags': top('tag'),
+        'users': top('user')
+    }
+
+
+def rebuild_statistics(db):
+    """Recompute the materialized statistics collection from the logs"""
+    db.stats.delete_many({})
+
+    for kind in ['tag', 'user']:
+        db.logs.aggregate([
+            {'$group': {'_id': '$' + kind, 'count': {'$sum': 1}}},
+            {'$project': {'_id': {'$concat': [kind + ':', '$_id']},
+                          'kind': {'$literal': kind}, 'name': '$_id', 'count': 1}},
+            {'$merge': {'into': 'stats', 'whenMatched': 'replace'}}
+        ])
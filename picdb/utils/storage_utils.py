@@ -0,0 +1,84 @@
+from gridfs import GridFSBucket
+
+
+class InlineStorage:
+    """Store the whole image content in the content field of the image document"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def put(self, image, content):
+        """Attach the content to an image document before it is inserted"""
+        image["content"] = content
+        image["size"] = len(content)
+
+        return image
+
+    def delete(self, image):
+        """Remove the content stored outside of an image document"""
+        pass
+
+    def read(self, image):
+        """Get the whole content of an image document"""
+        return image["content"]
+
+    def write(self, image, f):
+        """Write the content of an image document to a file object, return the written size"""
+        f.write(image["content"])
+
+        return len(image["content"])
+
+
+class ChunkedStorage(InlineStorage):
+    """
+    Store small images inline and large images in GridFS chunks.
+
+    Images larger than inline_limit are uploaded to the GridFS bucket and the
+    image document only keeps a blob_id reference, so they are not capped by
+    the 16 MB document size and do not slow down metadata queries.
+    """
+
+    def __init__(self, db, inline_limit=4 * 2**20, bucket_name="blobs"):
+        super().__init__(db)
+        self.inline_limit = inline_limit
+        self.bucket = GridFSBucket(db, bucket_name=bucket_name)
+
+    def put(self, image, content):
+        if len(content) <= self.inline_limit:
+            return super().put(image, content)
+
+        image["blob_id"] = self.bucket.upload_from_stream(
+            image.get("digest", "image"), content,
+            metadata={"img_type": image.get("img_type")})
+        image["size"] = len(content)
+
+        return image
+
+    def delete(self, image):
+        if "blob_id" in image:
+            self.bucket.delete(image["blob_id"])
+
+    def read(self, image):
+        if "blob_id" not in image:
+            return super().read(image)
+
+        return self.bucket.open_download_stream(image["blob_id"]).read()
+
+    def write(self, image, f):
+        if "blob_id" not in image:
+            return super().write(image, f)
+
+        # Stream chunk by chunk instead of materializing the whole blob
+        stream = self.bucket.open_download_stream(image["blob_id"])
+        size = 0
+        chunk = stream.readchunk()
+        while chunk:
+            f.write(chunk)
+            size += len(chunk)
+            chunk = stream.readchunk()
+
+        return size
+
+
+# The projection to fetch image content regardless of where it is stored
+CONTENT_PROJECTION = {"content": 1, "blob_id": 1, "img_type": 1, "digest": 1}
@@ -0,0 +1,161 @@
+from pymongo import UpdateOne, ReplaceOne, DeleteOne
+from pymongo.errors import CollectionInvalid
+
+
+# Collections of the database itself, a tag of the same name has no index
+# collection so that its index never replaces them
+RESERVED_COLLECTIONS = {'images', 'logs', 'stats', 'renditions', 'blobs.files', 'blobs.chunks'}
+
+
+def has_tag_collection(tag):
+    """Whether a tag can have an index collection, its name is not reserved"""
+    return tag not in RESERVED_COLLECTIONS and not tag.startswith('system.')
+
+
+def ensure_tag_collection(db, tag, known_collections):
+    """Create the index collection of a tag once, known_collections caches existing names"""
+    if tag in known_collections or not has_tag_collection(tag):
+        return
+
+    try:
+        db.create_collection(tag)
+    except CollectionInvalid:
+        # created by another client in the meantime
+        pass
+
+    known_collections.add(tag)
+
+
+def apply_tag_deltas(db, tag_deltas, threshold, known_collections):
+    """
+    Change tag credits of images and keep the per-tag index collections in sync.
+
+    Credits of all images are changed with one bulk write. Then the credits
+    are read back and every changed image is written to the index
+    collections from its current credit, upserted when it reaches the
+    threshold and deleted otherwise. These writes are idempotent, so
+    concurrent feedback on the same images cannot miss a threshold crossing
+    the way writes inferred from the deltas could.
+
+    Parameters:
+    ----------
+    tag_deltas: Dict[String, Dict[ObjectId, Int]]
+        the credit change of each image for each tag
+
+    threshold:
+        the credit from which an image is in the index of a tag
+
+    known_collections:
+        the set of tag collections known to exist, updated in place
+
+    Returns:
+    ----------
+    (added, removed):
+        the number of images added to and removed from the tag indexes
+
+    """
+    for tag in tag_deltas:
+        ensure_tag_collection(db, tag, known_collections)
+
+    credit_requests = make_credit_requests(tag_deltas)
+    if not credit_requests:
+        return 0, 0
+
+    db.images.bulk_write(credit_requests, ordered=False)
+
+    # Read the current credits back, they may include concurrent feedback
+    query, projection = make_credits_query(tag_deltas)
+    credits = {image['_id']: image.get('tags', {})
+               for image in db.images.find(query, projection)}
+
+    added, removed = 0, 0
+    for tag, requests in make_tag_index_requests(tag_deltas, credits, threshold).items():
+        result = db[tag].bulk_write(requests, ordered=False)
+        added += result.upserted_count
+        removed += result.deleted_count
+
+    return added, removed
+
+
+def make_credit_requests(tag_deltas):
+    """Combine the credit changes of every tag into one update per image"""
+    image_incs = {}
+    for tag, deltas in tag_deltas.items():
+        for image_id, delta in deltas.items():
+            if delta != 0:
+                image_incs.setdefault(image_id, {})['tags.%s' % tag] = delta
+
+    return [UpdateOne({'_id': image_id}, {'$inc': inc}) for image_id, inc in image_incs.items()]
+
+
+def make_credits_query(tag_deltas):
+    """Make the (filter, projection) reading the changed credits back"""
+    image_ids = {image_id for deltas in tag_deltas.values() for image_id in deltas}
+    projection = {'tags.%s' % tag: 1 for tag in tag_deltas}
+
+    return {'_id': {'$in': list(image_ids)}}, projection
+
+
+def make_tag_index_requests(tag_deltas, credits, threshold):
+    """
+    Make the index writes of the changed images from their current credits.
+
+    An image is upserted when its credit reaches the threshold and deleted
+    otherwise, whatever the delta was, so replaying the writes is harmless.
+    Tags named after a reserved collection have no index writes.
+
+    Returns:
+    ----------
+    tag_requests: Dict[String, List]
+        the requests of each tag collection
+
+    """
+    tag_requests = {}
+    for tag, deltas in tag_deltas.items():
+        if not has_tag_collection(tag):
+            continue
+
+        requests = []
+        for image_id, delta in deltas.items():
+            if delta == 0 or image_id not in credits:
+                continue
+
+            if credits[image_id].get(tag, 0) >= threshold:
+                requests.append(ReplaceOne({'_id': image_id}, {'_id': image_id}, upsert=True))
+            else:
+                requests.append(DeleteOne({'_id': image_id}))
+
+        if requests:
+            tag_requests[tag] = requests
+
+    return tag_requests
+
+
+def get_all_tags(db):
+    """Get all tag names having a credit on some image"""
+    result = db.images.aggregate([
+        {'$project': {'tags': {'$objectToArray': '$tags'}}},
+        {'$unwind': '$tags'},
+        {'$group': {'_id': '$tags.k'}}
+    ])
+
+    return [tag['_id'] for tag in result]
+
+
+def rebuild_tag_index(db, tag, threshold):
+    """
+    Rebuild the index collection of a tag from the credits in one aggregation.
+
+    The result replaces the collection atomically, so readers never see a
+    half-built index. Tags named after a reserved collection raise ValueError.
+    """
+    if not has_tag_collection(tag):
+        raise ValueError(f'Tag {tag} is named after a reserved collection')
+
+    db.images.aggregate([
+        {'$match': {'tags.%s' % tag: {'$gte': threshold}}},
+        {'$project': {'_id': 1}},
+        {'$out': tag}
+    ])
+
+    return db[tag].estimated_document_count()
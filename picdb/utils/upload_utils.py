@@ -0,0 +1,242 @@
+import io
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from pymongo.errors import BulkWriteError
+
+from .image_utils import get_image_digest
+from .stats_utils import increment_statistics
+from .phash_utils import compute_dhash, make_phash_fields, drop_near_duplicates
+
+
+def read_image_record(img_path, normalize=False):
+    """
+    Read an image file and convert it to the record stored in the database.
+
+    The original file bytes are stored as they are, only the image header is
+    parsed to get the format and dimensions, and a small grayscale thumbnail
+    is decoded for the perceptual hash. This function runs in worker
+    processes of the bulk upload, so it only depends on its arguments.
+
+    Parameters:
+    ----------
+    normalize:
+        True: Decode and re-encode the image with PIL before storing it
+        False: Store the original file bytes
+
+    Returns:
+    ----------
+    record: dict
+        includes path, content, digest, phash, img_type, width and height,
+        None if the file cannot be read
+
+    """
+    try:
+        with open(img_path, "rb") as f:
+            content = f.read()
+
+        # Image.open only parses the header, the pixels are not decoded here
+        im = Image.open(io.BytesIO(content))
+
+        if normalize:
+            # convert the image to binary
+            image_bytes = io.BytesIO()
+            im.save(image_bytes, format=im.format)
+            content = image_bytes.getvalue()
+    except (OSError, ValueError):
+        return None
+
+    width, height = im.size
+
+    return {
+        "path": img_path,
+        "content": content,
+        "digest": get_image_digest(content),
+        "phash": compute_dhash(content),
+        "img_type": str(im.format),
+        "width": width,
+        "height": height
+    }
+
+
+def make_tag_credits(tags_list_like):
+    """Create initial credits for tags, an image without tags is tagged as 'image'"""
+    credits_for_tags = {}
+    if len(tags_list_like) != 0:
+        for i in tags_list_like:
+            if i not in credits_for_tags.keys():
+                credits_for_tags[i] = 1
+    else:
+        credits_for_tags["image"] = 1
+
+    return credits_for_tags
+
+
+def make_image_document(record, up_loader, credits_for_tags, description):
+    """Create one record (row) of the images collection, the content is attached by the storage"""
+    image = {
+        "digest": record["digest"],
+        "description": description,
+        "img_type": record["img_type"],
+        "width": record["width"],
+        "height": record["height"],
+        "use_count": 0,
+        "uploader": up_loader,
+        "tags": credits_for_tags
+    }
+    if record.get("phash") is not None:
+        image.update(make_phash_fields(record["phash"]))
+
+    return image
+
+
+def make_upload_logs(image_id, credits_for_tags, up_loader):
+    """Create one log per tag of an uploaded image"""
+    return [{'tag': tag, 'user': up_loader, 'image_id': image_id}
+            for tag in credits_for_tags]
+
+
+def chunked(items, size):
+    """Split a list into consecutive chunks of the given size"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def insert_new_images(db, storage, records, up_loader, credits_for_tags, description,
+                      materialize_statistics=False, near_duplicate_radius=None):
+    """
+    Insert a batch of image records that are not in the database yet.
+
+    Duplicates are dropped with one digest query for the whole batch, and
+    near duplicates with one perceptual hash query if near_duplicate_radius
+    is given, then images and their logs are written with one insert_many each.
+
+    Returns:
+    ----------
+    (inserted, dedup_time, insert_time):
+        the inserted image documents and the time spent on each stage
+
+    """
+    start = perf_counter()
+
+    # Drop duplicates inside the batch and those already in the database
+    unique_records = {}
+    for record in records:
+        unique_records.setdefault(record["digest"], record)
+
+    existed = db.images.find(
+        {"digest": {"$in": list(unique_records)}}, {"digest": 1})
+    for image in existed:
+        unique_records.pop(image["digest"], None)
+
+    new_records = list(unique_records.values())
+    if near_duplicate_radius is not None:
+        new_records, _ = drop_near_duplicates(db, new_records, near_duplicate_radius)
+
+    dedup_time = perf_counter() - start
+    start = perf_counter()
+
+    documents = [storage.put(make_image_document(record, up_loader, credits_for_tags, description),
+                             record["content"])
+                 for record in new_records]
+    if not documents:
+        return [], dedup_time, perf_counter() - start
+
+    try:
+        db.images.insert_many(documents, ordered=False)
+        inserted = documents
+    except BulkWriteError as e:
+        # Images uploaded concurrently by others are rejected by the digest index
+        failed = {error["index"] for error in e.details["writeErrors"]}
+        inserted = [doc for i, doc in enumerate(documents) if i not in failed]
+        for i in failed:
+            storage.delete(documents[i])
+
+    logs = []
+    for doc in inserted:
+        logs += make_upload_logs(doc["_id"], credits_for_tags, up_loader)
+    if logs:
+        db.logs.insert_many(logs, ordered=False)
+        if materialize_statistics:
+            increment_statistics(db, logs)
+
+    return inserted, dedup_time, perf_counter() - start
+
+
+def bulk_upload_images(db, storage, img_paths, up_loader, tags_list_like=[],
+                       description="null", chunk_size=500, workers=None, normalize=False,
+                       materialize_statistics=False, near_duplicate_radius=None):
+    """
+    Upload many images with a batched and parallel pipeline.
+
+    Images are read and hashed in a process pool, the next chunk is being
+    decoded while the current one is written to the database.
+
+    Parameters:
+    ----------
+    storage:
+        the storage backend that stores the image content
+
+    img_paths:
+        the paths of images to upload
+
+    chunk_size:
+        the number of images deduplicated and inserted together
+
+    workers:
+        the number of decoding processes, default to the number of CPUs
+
+    normalize:
+        re-encode images with PIL instead of storing the original bytes
+
+    materialize_statistics:
+        count the upload logs into the materialized statistics collection
+
+    near_duplicate_radius:
+        skip images whose perceptual hash is within this Hamming distance
+        of an uploaded image, None to only skip exact duplicates
+
+    Returns:
+    ----------
+    stats: dict
+        the number of images, bytes and seconds spent on each stage
+
+    """
+    credits_for_tags = make_tag_credits(tags_list_like)
+    stats = {"read": 0, "failed": 0, "inserted": 0, "bytes": 0,
+             "decode_time": 0.0, "dedup_time": 0.0, "insert_time": 0.0}
+
+    chunks = chunked(img_paths, chunk_size)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def submit_next():
+            chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            return [pool.submit(read_image_record, path, normalize) for path in chunk]
+
+        pending = submit_next()
+        while pending is not None:
+            start = perf_counter()
+            records = [future.result() for future in pending]
+            stats["decode_time"] += perf_counter() - start
+
+            # Keep the pool busy with the next chunk while writing this one
+            pending = submit_next()
+
+            stats["failed"] += sum(record is None for record in records)
+            records = [record for record in records if record is not None]
+            stats["read"] += len(records)
+            stats["bytes"] += sum(len(record["content"]) for record in records)
+
+            inserted, dedup_time, insert_time = insert_new_images(
+                db, storage, records, up_loader, credits_for_tags, description,
+                materialize_statistics, near_duplicate_radius)
+            stats["inserted"] += len(inserted)
+            stats["dedup_time"] += dedup_time
+            stats["insert_time"] += insert_time
+
+            print(f'Uploaded {stats["inserted"]} of {stats["read"]} images ...')
+
+    return stats
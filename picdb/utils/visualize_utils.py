@@ -0,0 +1,37 @@
+# matplotlib, pandas and seaborn are only imported when something is
+# displayed, so headless upload and download workers do not pay for them
+from io import BytesIO
+
+
+def show_image_content(image_data):
+    """Display an image given its binary content"""
+    import matplotlib.pyplot as plt
+    from PIL import Image
+
+    image = Image.open(BytesIO(image_data))
+    plt.imshow(image)
+    plt.axis('off')
+    plt.show()
+
+
+def show_summary_statistics(summary, top_num):
+    """Display the total images, top tags and top users of a database summary"""
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+
+    fig = plt.figure(figsize=(8, 4))
+    fig.suptitle('There are {} images in database'.format(summary['total_images']))
+    ax1 = fig.add_subplot(121)
+    ax2 = fig.add_subplot(122)
+
+    # the number of each tag
+    tag_count = pd.DataFrame(summary['tags'], columns=['Tag_name', 'Tag_count'])
+    sns.barplot(x='Tag_name', y='Tag_count', data=tag_count, ax=ax1)
+    ax1.set_title('Top {} tags in database'.format(top_num), fontsize=8)
+
+    # the number of the user who add the tag
+    user_count = pd.DataFrame(summary['users'], columns=['User_name', 'Number'])
+    sns.barplot(x='User_name', y='Number', data=user_count, ax=ax2)
+    ax2.set_title('Top {} users to insert tag'.format(top_num), fontsize=8)
+    plt.show()
@@ -0,0 +1,110 @@
+import os
+import sys
+import asyncio
+import tempfile
+
+from PIL import Image
+
+# The image store of the test is created under a temporary home
+os.environ['HOME'] = tempfile.mkdtemp()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb'))
+
+try:
+    # The in-process stand-in of motor is only needed by this test
+    from mongomock_motor import AsyncMongoMockClient
+except ImportError:
+    print('Skipped: this test needs mongomock_motor, install it with pip install mongomock-motor')
+    sys.exit(0)
+
+from AsyncPicDB import AsyncPicDB
+from utils.image_utils import get_image_path
+
+
+def create_images(dir_path, count):
+    """Save count distinct JPEG files, return their paths"""
+    paths = []
+    for i in range(count):
+        path = os.path.join(dir_path, f'{i}.jpeg')
+        Image.new('RGB', (32, 32), (i * 20, 255 - i * 20, 0)).save(path)
+        paths.append(path)
+
+    return paths
+
+
+async def test_upload(db, paths):
+    ids = await asyncio.gather(*[db.upload_one_new_image(path, 'tester', ['cat']) for path in paths[:4]])
+    assert all(ids)
+    assert await db.upload_one_new_image(paths[0], 'tester', ['cat']) is None
+
+    untagged_id = await db.upload_one_new_image(paths[4], 'tester')
+    image = await db.show_information(untagged_id)
+    assert image['tags'] == {'image': 1}
+    assert await db.log_collection.count_documents({}) == 5
+
+    # A recompressed copy is skipped as a near duplicate
+    db.near_duplicate_radius = 4
+    copy_path = paths[0].replace('.jpeg', '-copy.jpeg')
+    Image.open(paths[0]).save(copy_path, quality=60)
+    assert await db.upload_one_new_image(copy_path, 'tester', ['cat']) is None
+    db.near_duplicate_radius = None
+    print('upload: ok')
+
+    return [str(id) for id in ids]
+
+
+async def test_query(db, ids, paths):
+    assert sorted(await db.query_images_id(['cat'])) == sorted(ids)
+    assert len(await db.query_images_id(['image'])) == 1
+
+    # Uploads invalidate the cached results of their tags
+    ids.append(str(await db.upload_one_new_image(paths[5], 'tester', ['cat'])))
+    assert sorted(await db.query_images_id(['cat'])) == sorted(ids)
+    assert await db.query_images_id(['dog']) == []
+    print('query: ok')
+
+
+async def test_feedback(db, ids):
+    # The credits reach the threshold, so the images enter the index of the tag
+    await db.feedback('tester', ['cat'], ids[:2], True)
+    assert {str(image['_id']) async for image in db.db.cat.find()} == set(ids[:2])
+
+    # Images of the index are returned first, the cached result is invalidated
+    assert sorted(await db.query_images_id(['cat'], limit=2)) == sorted(ids[:2])
+
+    await db.feedback('tester', ['cat'], ids[:1], False)
+    assert [str(image['_id']) async for image in db.db.cat.find()] == ids[1:2]
+    print('feedback: ok')
+
+
+async def test_get_images(db, ids):
+    images_list = await db.get_images(['cat'], limit=3, workers=2, batch_size=2)
+    assert len(images_list) == 3
+    for image_id in images_list:
+        assert image_id in db.manifest
+        assert os.path.isfile(get_image_path(db.dir_path, f'{image_id}.JPEG'))
+
+    assert await db.use_images(['cat']) == images_list
+
+    # A labeled version queries the database again
+    assert await db.get_images(['cat'], limit=len(ids), use_cache=False, next_cache_name='all') is not None
+    assert sorted(await db.use_images(['cat'], 1)) == sorted(ids)
+    assert len(db.manifest) == len(ids)
+    print('get_images: ok')
+
+
+async def main():
+    db = AsyncPicDB()
+    db.threshold = 2
+    await db.init(client=AsyncMongoMockClient())
+
+    paths = create_images(tempfile.mkdtemp(), 6)
+
+    ids = await test_upload(db, paths)
+    await test_query(db, ids, paths)
+    await test_feedback(db, ids)
+    await test_get_images(db, ids)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
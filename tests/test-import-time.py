@@ -0,0 +1,61 @@
+import os
+import sys
+import argparse
+import subprocess
+
+
+picdb_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb')
+
+# Modules of the optional visualization and loader layers, which must not load with PicDB
+lazy_modules = ['matplotlib', 'pandas', 'seaborn', 'numpy']
+
+
+def measure_import_time(module='PicDB'):
+    """Import the module in a fresh interpreter, return {module: (self_us, cumulative_us)}"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=picdb_path, capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Track the import time of PicDB')
+    parser.add_argument('--count', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='exit with an error when the import is slower')
+    args = parser.parse_args()
+
+    runs = [measure_import_time() for _ in range(args.count)]
+    total_ms = min(run['PicDB'][1] for run in runs) / 1000
+
+    print(f'Import PicDB: {total_ms:.1f} ms (best of {args.count})')
+    print('Slowest modules:')
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1][1], reverse=True)
+    for name, (_, cumulative_us) in slowest[:args.top]:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}')
+
+    failed = False
+    loaded = [name for name in lazy_modules if name in runs[-1]]
+    if loaded:
+        print(f'Optional modules imported at startup: {loaded}')
+        failed = True
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f'Import time exceeds {args.max_ms} ms!')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import zlib
+import shutil
+import argparse
+import tempfile
+from time import perf_counter
+
+from bson.objectid import ObjectId
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb'))
+
+from utils.image_utils import save_image, get_image_path
+from utils.shard_utils import pack_images, ShardReader
+
+
+def create_pool(dir_path, count, image_size):
+    """Save count random images of image_size bytes into a sharded pool"""
+    ids = [str(ObjectId()) for _ in range(count)]
+    for image_id in ids:
+        image = {'_id': image_id, 'img_type': 'JPEG', 'content': os.urandom(image_size)}
+        save_image(dir_path, image, verbose=False)
+
+    return ids
+
+
+def read_loose(dir_path, ids):
+    """Read every image file of the pool one by one"""
+    checksum = 0
+    for image_id in ids:
+        with open(get_image_path(dir_path, f'{image_id}.JPEG'), 'rb') as f:
+            checksum = zlib.crc32(f.read(), checksum)
+
+    return checksum
+
+
+def read_packed(packed_path):
+    """Read every image of the packed shards through mmap views"""
+    checksum = 0
+    with ShardReader(packed_path) as reader:
+        for _, view in reader:
+            checksum = zlib.crc32(view, checksum)
+            view.release()
+
+    return checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare reading loose images and packed shards')
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--image-size', type=int, default=64 * 1024)
+    parser.add_argument('--shard-size', type=int, default=2**30)
+    parser.add_argument('--dir', default=None, help='where to create the test pool')
+    args = parser.parse_args()
+
+    dir_path = tempfile.mkdtemp(dir=args.dir)
+    try:
+        ids = create_pool(dir_path, args.count, args.image_size)
+        packed_path = os.path.join(dir_path, 'packed')
+        cache_info = {'tags': ['test'], 'use_count': -1, 'limit': args.count}
+        pack_images(dir_path, ids, 'JPEG', packed_path, cache_info, shard_size=args.shard_size)
+
+        total = args.count * args.image_size / 2**20
+        print(f'{args.count} images, {total:.0f} MB (the page cache is warm for both):')
+
+        start = perf_counter()
+        loose = read_loose(dir_path, ids)
+        seconds = perf_counter() - start
+        print(f'  loose: {seconds:.2f}s, {total / seconds:.0f} MB/s')
+
+        start = perf_counter()
+        packed = read_packed(packed_path)
+        seconds = perf_counter() - start
+        print(f' packed: {seconds:.2f}s, {total / seconds:.0f} MB/s')
+
+        assert loose == packed
+    finally:
+        shutil.rmtree(dir_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import sys
+import random
+from time import perf_counter
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb'))
+
+from utils.index_utils import ensure_indexes
+from utils.phash_utils import BKTree, hamming_distance, make_phash_fields
+from utils.phash_utils import find_near_duplicate_images, find_near_duplicate_pairs, cluster_pairs
+
+
+def flip_bits(value, count):
+    """Flip count distinct random bits of a 64 bits hash"""
+    for bit in random.sample(range(64), count):
+        value ^= 1 << bit
+
+    return value
+
+
+def make_hashes(count, copies, max_flips):
+    """Random hashes, each followed by copies near duplicates within max_flips bits"""
+    values = []
+    for _ in range(count):
+        value = random.getrandbits(64)
+        values.append(value)
+        values += [flip_bits(value, random.randint(0, max_flips)) for _ in range(copies)]
+
+    return values
+
+
+def brute_force_pairs(values, radius):
+    return {(i, j) for i in range(len(values)) for j in range(i + 1, len(values))
+            if hamming_distance(values[i], values[j]) <= radius}
+
+
+def brute_force_clusters(values, radius):
+    """Connected components of the near duplicate graph by depth first search"""
+    neighbours = {i: set() for i in range(len(values))}
+    for i, j in brute_force_pairs(values, radius):
+        neighbours[i].add(j)
+        neighbours[j].add(i)
+
+    seen, clusters = set(), []
+    for i in range(len(values)):
+        if i in seen or not neighbours[i]:
+            continue
+        stack, cluster = [i], []
+        seen.add(i)
+        while stack:
+            node = stack.pop()
+            cluster.append(node)
+            for other in neighbours[node] - seen:
+                seen.add(other)
+                stack.append(other)
+        clusters.append(sorted(cluster))
+
+    return sorted(clusters)
+
+
+def test_segment_lookup(db, values, radius):
+    db.images.drop()
+    ids = db.images.insert_many([dict(make_phash_fields(value), digest=str(i))
+                                 for i, value in enumerate(values)]).inserted_ids
+    ensure_indexes(db)
+
+    for value in random.sample(values, 50):
+        expected = {id for id, other in zip(ids, values)
+                    if hamming_distance(value, other) <= radius}
+        found = find_near_duplicate_images(db, value, radius)
+
+        assert {id for id, _ in found} == expected
+        assert [distance for _, distance in found] == sorted(distance for _, distance in found)
+    print(f'segment lookup (radius {radius}): ok')
+
+
+def test_bk_tree(values, radius):
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    assert len(tree) == len(values)
+
+    for value in random.sample(values, 50):
+        expected = {(i, hamming_distance(value, other)) for i, other in enumerate(values)
+                    if hamming_distance(value, other) <= radius}
+        assert set(tree.query(value, radius)) == expected
+    print(f'BK-tree (radius {radius}): ok')
+
+
+def test_clustering(values, radius):
+    start = perf_counter()
+    pairs = find_near_duplicate_pairs(values, radius, workers=2, chunk_size=100)
+    seconds = perf_counter() - start
+
+    assert set(pairs) == brute_force_pairs(values, radius)
+    assert sorted(cluster_pairs(len(values), pairs)) == brute_force_clusters(values, radius)
+
+    # Pairs chain into one cluster
+    assert cluster_pairs(5, [(0, 1), (3, 4), (1, 2)]) == [[0, 1, 2], [3, 4]]
+    print(f'clustering (radius {radius}): ok, {len(pairs)} pairs in {seconds:.2f}s')
+
+
+def main():
+    connection = MongoClient('localhost', 27017)
+    db = connection.test_picdb_phash
+
+    random.seed(0)
+    values = make_hashes(300, 2, 8)
+
+    for radius in [0, 4, 8]:
+        test_segment_lookup(db, values, radius)
+        test_bk_tree(values, radius)
+        test_clustering(values, radius)
+
+
+if __name__ == "__main__":
+    main()
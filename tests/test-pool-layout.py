@@ -0,0 +1,80 @@
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+from time import perf_counter
+
+from bson.objectid import ObjectId
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb'))
+
+from utils.image_utils import get_image_path, iter_pool_files
+
+
+def create_pool(dir_path, ids, sharded):
+    """Create empty image files in the flat or sharded layout"""
+    for image_id in ids:
+        image_name = f'{image_id}.JPEG'
+        if sharded:
+            path = get_image_path(dir_path, image_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        else:
+            path = os.path.join(dir_path, image_name)
+        open(path, 'wb').close()
+
+
+def measure(dir_path, ids, sharded, lookups):
+    """Time creating the pool, listing all images and looking up random images"""
+    start = perf_counter()
+    create_pool(dir_path, ids, sharded)
+    create_time = perf_counter() - start
+
+    start = perf_counter()
+    if sharded:
+        listed = sum(1 for _ in iter_pool_files(dir_path))
+    else:
+        listed = sum(1 for entry in os.scandir(dir_path) if entry.is_file())
+    list_time = perf_counter() - start
+
+    samples = random.sample(ids, min(lookups, len(ids)))
+    start = perf_counter()
+    for image_id in samples:
+        image_name = f'{image_id}.JPEG'
+        if sharded:
+            os.path.exists(get_image_path(dir_path, image_name))
+        else:
+            os.path.exists(os.path.join(dir_path, image_name))
+    lookup_time = (perf_counter() - start) / len(samples)
+
+    assert listed == len(ids)
+
+    return create_time, list_time, lookup_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the flat and sharded image pool layouts')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--dir', default=None, help='where to create the test pools')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        ids = [str(ObjectId()) for _ in range(size)]
+        print(f'{size} images:')
+
+        for sharded in [False, True]:
+            dir_path = tempfile.mkdtemp(dir=args.dir)
+            try:
+                create_time, list_time, lookup_time = measure(dir_path, ids, sharded, args.lookups)
+            finally:
+                shutil.rmtree(dir_path)
+
+            layout = 'sharded' if sharded else 'flat'
+            print(f'  {layout:>7}: create {create_time:.2f}s, list {list_time:.3f}s, '
+                  f'lookup {lookup_time * 1e6:.1f} us')
+
+
+if __name__ == "__main__":
+    main()
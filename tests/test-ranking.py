@@ -0,0 +1,101 @@
+import os
+import sys
+import random
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb'))
+
+from utils.db_utils import get_ranked_images_from_database
+from utils.index_utils import ensure_indexes
+
+
+tags_pool = ['cat', 'dog', 'orange']
+
+
+def populate(db, size):
+    """Fill a synthetic images collection whose credits have many ties"""
+    db.images.drop()
+
+    docs = []
+    for i in range(size):
+        tags = random.sample(tags_pool, random.randint(1, 3))
+        docs.append({
+            "digest": str(i),
+            "img_type": "JPEG",
+            "use_count": 0,
+            "tags": {tag: random.randint(0, 5) for tag in tags}
+        })
+    db.images.insert_many(docs)
+
+    ensure_indexes(db)
+
+
+def expected_ranking(db, tags, weights=None):
+    """Rank the images having all tags in Python, as (id, score) in descending score then _id order"""
+    weights = {tag: (weights or {}).get(tag, 1) for tag in tags}
+    scored = []
+    for image in db.images.find({'tags.%s' % tag: {'$exists': True} for tag in tags}):
+        score = sum(weight * image['tags'][tag] for tag, weight in weights.items())
+        scored.append((image['_id'], score))
+
+    scored.sort(key=lambda item: (-item[1], item[0]))
+
+    return [(str(id), score) for id, score in scored]
+
+
+def test_ordering(db, limit):
+    ranked = get_ranked_images_from_database(db, ['cat', 'dog'], "JPEG", -1, limit)
+    scores = [score for _, score in ranked]
+
+    assert len(ranked) == min(limit, len(expected_ranking(db, ['cat', 'dog'])))
+    assert scores == sorted(scores, reverse=True)
+    print('ordering: ok')
+
+
+def test_ties(db, limit):
+    # Several tags break ties on _id
+    expected = expected_ranking(db, ['cat', 'dog'])[:limit]
+    assert get_ranked_images_from_database(db, ['cat', 'dog'], "JPEG", -1, limit) == expected
+
+    # A single tag comes in index order among equal credits, only the scores are fixed
+    expected = expected_ranking(db, ['cat'])
+    ranked = get_ranked_images_from_database(db, ['cat'], "JPEG", -1, limit)
+    assert [score for _, score in ranked] == [score for _, score in expected[:limit]]
+
+    # Every image of the last score kept is a valid tie
+    last_score = ranked[-1][1]
+    tied = {id for id, score in expected if score == last_score}
+    assert {id for id, score in ranked if score == last_score} <= tied
+    assert {id for id, score in ranked if score > last_score} == \
+        {id for id, score in expected if score > last_score}
+    print('ties: ok')
+
+
+def test_weights(db, limit):
+    for weights in [{'cat': 2, 'dog': 0.5}, {'cat': -1, 'dog': 1}, {'dog': 0}]:
+        expected = expected_ranking(db, ['cat', 'dog'], weights)[:limit]
+        ranked = get_ranked_images_from_database(db, ['cat', 'dog'], "JPEG", -1, limit, weights)
+        assert ranked == expected, weights
+
+    # A negative weight of a single tag ranks the lowest credits first
+    expected = expected_ranking(db, ['cat'], {'cat': -1})[:limit]
+    assert get_ranked_images_from_database(db, ['cat'], "JPEG", -1, limit, {'cat': -1}) == expected
+    print('weights: ok')
+
+
+def main():
+    connection = MongoClient('localhost', 27017)
+    db = connection.test_picdb_ranking
+
+    random.seed(0)
+    populate(db, 2000)
+
+    for limit in [1, 10, 100]:
+        test_ordering(db, limit)
+        test_ties(db, limit)
+        test_weights(db, limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import random
+import argparse
+from time import perf_counter
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'picdb'))
+
+from utils.db_utils import get_images_id_from_database, get_images_id_from_tag_collections
+from utils.index_utils import ensure_indexes
+
+
+THRESHOLD = 100
+
+tags_pool = ['cat', 'dog', 'orange', 'black', 'white', 'cute', 'puppy', 'anime']
+
+
+def populate(db, size, batch_size=10000):
+    """Fill a synthetic images collection and the per-tag index collections"""
+    db.images.drop()
+    for tag in tags_pool:
+        db[tag].drop()
+
+    print(f'Populating {size} synthetic images ...')
+    for start in range(0, size, batch_size):
+        docs = []
+        for _ in range(min(batch_size, size - start)):
+            tags = random.sample(tags_pool, random.randint(1, 4))
+            docs.append({
+                "img_type": random.choice(["JPEG", "PNG"]),
+                "use_count": random.randint(0, 100),
+                "tags": {tag: random.randint(-20, 200) for tag in tags}
+            })
+        db.images.insert_many(docs)
+
+    ensure_indexes(db)
+
+    # The per-tag collections hold images whose credit reaches the threshold
+    for tag in tags_pool:
+        db.images.aggregate([
+            {"$match": {f'tags.{tag}': {"$gte": THRESHOLD}}},
+            {"$project": {"_id": 1}},
+            {"$out": tag}
+        ])
+
+
+def measure(func, db, tags, limit, count, **kwargs):
+    start = perf_counter()
+    for _ in range(count):
+        result = func(db, tags, "JPEG", -1, limit, **kwargs)
+    stop = perf_counter()
+
+    return (stop - start) / count, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare tag query paths')
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--count', type=int, default=5)
+    parser.add_argument('--skip-populate', action='store_true')
+    args = parser.parse_args()
+
+    connection = MongoClient('localhost', 27017)
+    db = connection.test_picdb_bench
+
+    if not args.skip_populate:
+        populate(db, args.size)
+
+    for tags in [['cat'], ['cat', 'orange'], ['dog', 'white', 'puppy']]:
+        old_time, old_num = measure(
+            get_images_id_from_tag_collections, db, tags, args.limit, args.count)
+        new_time, new_num = measure(
+            get_images_id_from_database, db, tags, args.limit, args.count, threshold=THRESHOLD)
+
+        print(f'Tags: {tags}')
+        print(f'  tag collections: {old_time:.4f}s ({old_num} images)')
+        print(f'  pushdown:        {new_time:.4f}s ({new_num} images)')
+
+
+if __name__ == "__main__":
+    main()